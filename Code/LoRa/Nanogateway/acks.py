@@ -0,0 +1,135 @@
+""" PUSH_DATA acknowledgement tracking for the LoPy nano gateway. """
+
+import utime
+
+ACK_SLOTS = 16
+ACK_TIMEOUT_MS = 2000
+RTT_SAMPLES = 32
+
+
+class AckTracker:
+    """
+    Bounded table of the PUSH_DATA tokens waiting for their PUSH_ACK. It
+    provides the real ackr of the stat packet, round trip time percentiles
+    and, optionally, keeps a copy of the uplinks so that an unacknowledged
+    one can be sent once more before it is given up.
+
+    The table is preallocated, a token that is still outstanding when its
+    slot is needed again counts as lost.
+    """
+
+    def __init__(self, slots=ACK_SLOTS, timeout_ms=ACK_TIMEOUT_MS, retransmit=False):
+        self.timeout_ms = timeout_ms
+        self.retransmit = retransmit
+
+        self.tokens = [-1] * slots
+        self.sent_ms = [0] * slots
+        self.packets = [None] * slots
+        self.next = 0
+
+        self.rtts = [0] * RTT_SAMPLES
+        self.rtt_count = 0
+
+        self.pushed = 0
+        self.acked = 0
+        self.lost = 0
+        self.retransmitted = 0
+
+        # acknowledged and lost since the last stat packet
+        self.window_acked = 0
+        self.window_lost = 0
+
+    def sent(self, token, packet=None):
+        """
+        Registers a PUSH_DATA. packet is kept for a retransmission when
+        enabled, it must be a copy owned by the tracker.
+        """
+
+        i = self.next
+        if self.tokens[i] >= 0:
+            self._lose(i)
+        self.tokens[i] = token
+        self.sent_ms[i] = utime.ticks_ms()
+        self.packets[i] = packet if self.retransmit else None
+        self.next = (i + 1) % len(self.tokens)
+        self.pushed += 1
+
+    def ack(self, token):
+        """
+        Handles a PUSH_ACK, returns its round trip time in ms or -1 if the
+        token is unknown, e.g. a duplicate ack.
+        """
+
+        for i in range(len(self.tokens)):
+            if self.tokens[i] == token:
+                rtt = utime.ticks_diff(utime.ticks_ms(), self.sent_ms[i])
+                self.tokens[i] = -1
+                self.packets[i] = None
+                self.rtts[self.rtt_count % RTT_SAMPLES] = rtt
+                self.rtt_count += 1
+                self.acked += 1
+                self.window_acked += 1
+                return rtt
+        return -1
+
+    def expired(self):
+        """
+        Expires the tokens older than the timeout. Returns the list of
+        packets to send once more, or None. The caller registers them again,
+        without a packet copy, with the new token it sends them with.
+        """
+
+        now = utime.ticks_ms()
+        resend = None
+        for i in range(len(self.tokens)):
+            if self.tokens[i] >= 0 and utime.ticks_diff(now, self.sent_ms[i]) > self.timeout_ms:
+                packet = self.packets[i]
+                if packet is None:
+                    self._lose(i)
+                    continue
+                # not lost yet, the retransmission gets a new slot
+                self.tokens[i] = -1
+                self.packets[i] = None
+                if resend is None:
+                    resend = []
+                resend.append(packet)
+                self.retransmitted += 1
+        return resend
+
+    def ackr(self):
+        """
+        Returns the percentage of PUSH_DATA acknowledged since the previous
+        call, in tenths of a percent, and starts a new window.
+        """
+
+        total = self.window_acked + self.window_lost
+        ratio = 1000 if not total else self.window_acked * 1000 // total
+        self.window_acked = 0
+        self.window_lost = 0
+        return ratio
+
+    def rtt_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Returns the given round trip time percentiles in ms over the last
+        acknowledged packets, or None if there are no samples yet.
+        """
+
+        n = min(self.rtt_count, RTT_SAMPLES)
+        if not n:
+            return None
+        rtts = sorted(self.rtts[:n])
+        return [rtts[min(n - 1, p * n // 100)] for p in percentiles]
+
+    def give_up(self):
+        """
+        Counts as lost a packet that left the table for a retransmission
+        which could not be sent.
+        """
+
+        self.lost += 1
+        self.window_lost += 1
+
+    def _lose(self, i):
+        self.tokens[i] = -1
+        self.packets[i] = None
+        self.give_up()
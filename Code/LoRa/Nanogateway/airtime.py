@@ -0,0 +1,129 @@
+""" LoRa time on air and duty cycle accounting for the LoPy nano gateway. """
+
+import utime
+
+# symbol time in microseconds at 125 kHz per SF, halved for each doubling
+# of the bandwidth, and whether the low data rate optimization is on
+_TSYM_125 = [(1 << sf) * 8 for sf in range(13)]
+_LDRO_125 = [sf >= 11 for sf in range(13)]
+_BW_SHIFT = {125: 0, 250: 1, 500: 2}
+
+# EU868 sub-bands of ETSI EN 300 220 used by LoRaWAN, as
+# (first Hz, last Hz, duty cycle in thousandths)
+EU868_BANDS = (
+    (863000000, 868000000, 10),
+    (868000000, 868600000, 10),
+    (868700000, 869200000, 1),
+    (869400000, 869650000, 100),
+    (869700000, 870000000, 10),
+)
+
+DUTY_WINDOW_MS = 3600000
+DUTY_BUCKETS = 60
+
+
+def airtime_us(sf, bw_khz, size, preamble=8, crc=False, cr=1, header=True):
+    """
+    Returns the time on air of a LoRa packet in microseconds. cr is the
+    coding rate denominator minus 4 (1 for 4/5), header whether the header
+    is explicit. Downlinks are sent without a payload CRC.
+    """
+
+    shift = _BW_SHIFT[bw_khz]
+    tsym = _TSYM_125[sf] >> shift
+    de = 1 if shift == 0 and _LDRO_125[sf] else 0
+    num = 8 * size - 4 * sf + 28 - (0 if header else 20) + (16 if crc else 0)
+    symbols = 8
+    if num > 0:
+        den = 4 * (sf - 2 * de)
+        symbols += -(-num // den) * (cr + 4)
+    return (4 * preamble + 17) * tsym // 4 + symbols * tsym
+
+
+def datr_to_sf_bw(datr):
+    """
+    Splits a LoRa data rate string like 'SF9BW125' in (sf, bw_khz).
+    """
+
+    i = datr.index('BW')
+    return int(datr[2:i]), int(datr[i + 2:])
+
+
+class DutyCycle:
+    """
+    Sliding window transmit time accounting per regulatory sub-band. The
+    window is split in buckets so the memory is fixed and the budget is
+    released bucket by bucket as it slides; a transmission is only allowed
+    when it fits in what is left of the budget of its sub-band.
+    """
+
+    def __init__(self, bands=EU868_BANDS, window_ms=DUTY_WINDOW_MS, buckets=DUTY_BUCKETS):
+        self.bands = bands
+        self.bucket_ms = window_ms // buckets
+        # transmit microseconds allowed per window, per band
+        self.budget_us = [window_ms * band[2] for band in bands]
+        self.used = [[0] * buckets for band in bands]
+        self.used_us = [0] * len(bands)
+        self.current = 0
+        self.current_ms = utime.ticks_ms()
+
+        self.refused = 0
+
+    def band(self, freq):
+        """
+        Returns the index of the sub-band of freq in Hz, or -1 if it is not
+        in any of them.
+        """
+
+        for i in range(len(self.bands)):
+            if self.bands[i][0] <= freq <= self.bands[i][1]:
+                return i
+        return -1
+
+    def allowed(self, freq, airtime):
+        """
+        Returns whether airtime microseconds can be transmitted on freq now.
+        Frequencies outside the sub-bands are refused.
+        """
+
+        i = self.band(freq)
+        self._slide()
+        if i < 0 or self.used_us[i] + airtime > self.budget_us[i]:
+            self.refused += 1
+            return False
+        return True
+
+    def add(self, freq, airtime):
+        """
+        Charges a transmission to the budget of its sub-band.
+        """
+
+        i = self.band(freq)
+        if i < 0:
+            return
+        self._slide()
+        self.used[i][self.current] += airtime
+        self.used_us[i] += airtime
+
+    def usage(self):
+        """
+        Returns the used share of the budget of every sub-band, in
+        thousandths.
+        """
+
+        self._slide()
+        return [self.used_us[i] * 1000 // self.budget_us[i] for i in range(len(self.bands))]
+
+    def _slide(self):
+        # move to the current bucket, freeing the expired ones on the way
+        elapsed = utime.ticks_diff(utime.ticks_ms(), self.current_ms)
+        if elapsed < self.bucket_ms:
+            return
+        buckets = len(self.used[0]) if self.used else 1
+        steps = min(elapsed // self.bucket_ms, buckets)
+        for k in range(steps):
+            self.current = (self.current + 1) % buckets
+            for i in range(len(self.bands)):
+                self.used_us[i] -= self.used[i][self.current]
+                self.used[i][self.current] = 0
+        self.current_ms = utime.ticks_add(self.current_ms, (elapsed // self.bucket_ms) * self.bucket_ms)
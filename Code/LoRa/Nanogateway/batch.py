@@ -0,0 +1,64 @@
+""" RAM batching of the records written to flash by the LoPy nano gateway. """
+
+import _thread
+import utime
+
+
+class WriteBatch:
+    """
+    Collects records in RAM so that flash is written in batches, limiting
+    its wear. A batch is due once it holds batch_bytes, or once its oldest
+    record has waited flush_ms; the owner takes it and writes it out. With
+    max_bytes set, records that would make the batch larger are dropped.
+    """
+
+    def __init__(self, batch_bytes, flush_ms, max_bytes=None):
+        self.batch_bytes = batch_bytes
+        self.flush_ms = flush_ms
+        self.max_bytes = max_bytes
+        self.lock = _thread.allocate_lock()
+
+        self.buf = bytearray()
+        self.buf_ms = 0
+
+        self.dropped = 0
+
+    def add(self, header, data):
+        """
+        Appends one record, header then data. Returns False if it was
+        dropped because the batch is at max_bytes.
+        """
+
+        with self.lock:
+            if self.max_bytes and len(self.buf) + len(header) + len(data) > self.max_bytes:
+                self.dropped += 1
+                return False
+            if not self.buf:
+                self.buf_ms = utime.ticks_ms()
+            self.buf.extend(header)
+            self.buf.extend(data)
+        return True
+
+    def full(self):
+        return len(self.buf) >= self.batch_bytes
+
+    def due(self):
+        """
+        Returns whether the batch should be written out now.
+        """
+
+        return len(self.buf) >= self.batch_bytes or \
+            (len(self.buf) > 0 and utime.ticks_diff(utime.ticks_ms(), self.buf_ms) >= self.flush_ms)
+
+    def take(self):
+        """
+        Returns the pending records and starts a new batch.
+        """
+
+        with self.lock:
+            buf = self.buf
+            self.buf = bytearray()
+        return buf
+
+    def __len__(self):
+        return len(self.buf)
@@ -0,0 +1,83 @@
+""" Heap allocations per forwarded frame, per-packet concatenation vs PacketBuilder.
+
+Copy next to nanogateway.py and run with `import bench_alloc` from the REPL,
+or run it with CPython on a PC, where tracemalloc reports the peak allocated
+while forwarding a single frame instead.
+"""
+
+import gc
+import sys
+
+if sys.implementation.name != 'micropython':
+    # on a PC the u-modules come from the stand-ins in host/upy
+    sys.path.insert(0, __file__.rpartition('/')[0] + '/host/upy' if '/' in __file__ else 'host/upy')
+
+import ubinascii  # noqa: E402
+import uos  # noqa: E402
+from semtech import PacketBuilder  # noqa: E402
+
+GATEWAY_ID = '30AEA4FFFE5905C0'
+PUSH_DATA = 0
+FRAMES = 200
+
+BODY = (b'{"rxpk":[{"time": "2019-04-02T10:20:30.123456Z", "tmst": 123456789, "chan": 0, '
+        b'"rfch": 0, "freq": 868.1, "stat": 1, "modu": "LORA", "datr": "SF7BW125", "codr": "4/5", '
+        b'"rssi": -57, "lsnr": 9.5, "size": 23, "data": "QDDaAQGAAQABnMzBmE/ZAEtGeiGCvz0="}]}')
+
+
+class NullSocket:
+
+    def sendto(self, packet, addr):
+        return len(packet)
+
+
+try:
+    _mem_alloc = gc.mem_alloc
+
+    def measure(fn):
+        gc.collect()
+        gc.disable()
+        before = _mem_alloc()
+        fn(FRAMES)
+        used = _mem_alloc() - before
+        gc.enable()
+        return used // FRAMES
+except AttributeError:
+    import tracemalloc
+
+    def measure(fn):
+        fn(1)
+        gc.collect()
+        tracemalloc.start()
+        fn(1)
+        used = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return used
+
+
+def concat_frames(sock, body, frames):
+    for _ in range(frames):
+        token = uos.urandom(2)
+        packet = bytes([2]) + token + bytes([PUSH_DATA]) + ubinascii.unhexlify(GATEWAY_ID) + body
+        sock.sendto(packet, None)
+
+
+def builder_frames(sock, body, pkt, frames):
+    for _ in range(frames):
+        pkt.begin(PUSH_DATA)
+        pkt.append(body)
+        sock.sendto(pkt.packet(), None)
+
+
+def run():
+    sock = NullSocket()
+    pkt = PacketBuilder(GATEWAY_ID)
+
+    before = measure(lambda n: concat_frames(sock, BODY, n))
+    after = measure(lambda n: builder_frames(sock, BODY, pkt, n))
+
+    print('concatenation:    {} bytes/frame'.format(before))
+    print('PacketBuilder:    {} bytes/frame'.format(after))
+
+
+run()
@@ -0,0 +1,112 @@
+""" Binary capture of the received LoRa frames for the LoPy nano gateway. """
+
+import uos
+import ustruct
+import _thread
+import utime
+from batch import WriteBatch
+
+CAPTURE_BYTES = 131072
+CAPTURE_BATCH_BYTES = 2048
+CAPTURE_FLUSH_MS = 10000
+# records waiting for the supervisor to write them, beyond this they are
+# dropped rather than written from the packet path
+CAPTURE_BUFFER_BYTES = 8192
+
+# every file starts with FILE_MAGIC and the format version
+FILE_MAGIC = b'LPCAP'
+FILE_VERSION = 1
+FILE_HEADER = '<5sBH'
+FILE_HEADER_LEN = 8
+
+# magic, sf, payload length, unix seconds, microseconds, tmst, frequency in
+# Hz, rssi in dBm, snr in quarter dB, bandwidth in 125 kHz units; the
+# PHYPayload follows
+RECORD_MAGIC = 0xC5
+RECORD_HEADER = '<BBHIIIIhbB'
+RECORD_HEADER_LEN = 24
+
+
+class Capture:
+    """
+    Appends a fixed layout record for every frame the radio received to a
+    file on flash, for offline analysis with host/capture_reader.py.
+
+    Records are collected in RAM and written in batches of batch_bytes, or
+    when the oldest one has waited flush_ms, by whoever calls maybe_flush()
+    periodically, never by add(). Up to buffer_bytes wait in RAM, records
+    beyond are counted as dropped. The capture takes at most max_bytes of
+    flash: when the file reaches half of it, it is renamed to path.1,
+    replacing the previous one.
+    """
+
+    def __init__(self, path, bw_khz=125, max_bytes=CAPTURE_BYTES, batch_bytes=CAPTURE_BATCH_BYTES,
+                 flush_ms=CAPTURE_FLUSH_MS, buffer_bytes=CAPTURE_BUFFER_BYTES):
+        self.path = path
+        self.bw = bw_khz // 125
+        self.file_bytes = max_bytes // 2
+        self.batch = WriteBatch(batch_bytes, flush_ms, max_bytes=buffer_bytes)
+        self.write_lock = _thread.allocate_lock()
+
+        self.records = 0
+        self.written = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def add(self, rx_time, tmst, freq, sf, rssi, snr, data):
+        """
+        Queues one frame, rx_time being an RTC.now() tuple.
+        """
+
+        secs = utime.mktime(rx_time[:6] + (0, 0))
+        header = ustruct.pack(RECORD_HEADER, RECORD_MAGIC, sf, len(data), secs, rx_time[6],
+                              tmst & 0xFFFFFFFF, freq, int(rssi), int(snr * 4), self.bw)
+        if self.batch.add(header, data):
+            self.records += 1
+
+    def dropped(self):
+        return self.batch.dropped
+
+    def maybe_flush(self):
+        """
+        Writes the batch if it is full or its oldest record has waited long
+        enough.
+        """
+
+        if self.batch.due():
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out the pending records. The batch is swapped out first, so
+        the RX worker can keep adding records during the write.
+        """
+
+        buf = self.batch.take()
+        if not buf:
+            return
+        with self.write_lock:
+            try:
+                with self._open() as f:
+                    f.write(buf)
+                self.written += len(buf)
+            except OSError:
+                self.errors += 1
+
+    def _open(self):
+        try:
+            size = uos.stat(self.path)[6]
+        except OSError:
+            size = 0
+        if size >= self.file_bytes:
+            try:
+                uos.remove(self.path + '.1')
+            except OSError:
+                pass
+            uos.rename(self.path, self.path + '.1')
+            self.rotations += 1
+            size = 0
+        f = open(self.path, 'ab')
+        if size == 0:
+            f.write(ustruct.pack(FILE_HEADER, FILE_MAGIC, FILE_VERSION, RECORD_HEADER_LEN))
+        return f
@@ -10,9 +10,104 @@ GATEWAY_ID = WIFI_MAC[:6] + "FFFE" + WIFI_MAC[6:12]
 SERVER = 'router.eu.thethings.network'
 PORT = 1700
 
+# network servers to forward to, as (host, port); with 'fanout' every uplink
+# goes to all of them, with 'failover' only to the first one that is up.
+# Downlinks are accepted from the first server that is up only
+SERVERS = [(SERVER, PORT)]
+# SERVERS = [(SERVER, PORT), ('192.168.1.10', 1700)]
+SERVER_MODE = 'fanout'
+
 NTP = "pool.ntp.org"
 NTP_PERIOD_S = 3600
 
+# uplinks arriving within this window (ms) share one PUSH_DATA datagram,
+# up to PUSH_BATCH_MAX frames; 0 pushes every frame on its own
+PUSH_WINDOW_MS = 50
+PUSH_BATCH_MAX = 8
+
+# number of received frames buffered between the radio callback and the
+# forwarding thread, frames arriving while it is full are dropped
+RX_RING_SLOTS = 8
+
+# measure the delay between the downlink alarm and the radio starting to
+# transmit, and use it as the alarm lead time of class A downlinks
+TX_CALIBRATE = True
+
+# a PUSH_DATA not acknowledged within this time counts as lost, with
+# PUSH_RETRANSMIT uplinks are sent once more before they are given up
+PUSH_ACK_TIMEOUT_MS = 2000
+PUSH_RETRANSMIT = False
+
+# uplinks that cannot be sent are stored on flash, up to SPOOL_BYTES, and
+# replayed one every SPOOL_RATE_MS once the server answers again;
+# None disables the spool
+SPOOL_PATH = '/flash/spool'
+SPOOL_BYTES = 65536
+SPOOL_RATE_MS = 200
+
+# reopen the UDP socket when no PULL_ACK arrived for this long, and
+# resolve the server name again this often
+PULL_ACK_TIMEOUT_S = 90
+DNS_PERIOD_S = 3600
+
+# PULL_DATA keepalive interval bounds: the minimum while downlinks arrive
+# or after a PULL_ACK went missing, growing to the maximum when idle. The
+# keepalive also holds the NAT binding the downlinks come back through, and
+# an expired binding goes unnoticed: the next PULL_DATA opens a new one and
+# is acknowledged, but the downlinks sent meanwhile are lost. Only raise
+# PULL_MAX_S above 25 when the NAT timeout of the backhaul is known to be
+# longer. The stat packets likewise go from STAT_MIN_S, the former fixed 60 s
+# so that they are never sent more often, to STAT_MAX_S when idle; set both
+# bounds equal for a fixed interval, e.g. 25 s and 60 s
+PULL_MIN_S = 10
+PULL_MAX_S = 25
+STAT_MIN_S = 60
+STAT_MAX_S = 300
+
+# class C downlinks are queued, up to CLASS_C_QUEUE_SIZE, and paced so that
+# they take at most CLASS_C_TX_PERCENT of the radio time, the rest is left
+# to receiving uplinks
+CLASS_C_QUEUE_SIZE = 16
+CLASS_C_TX_PERCENT = 50
+
+# record every frame the radio received, with its timestamp, tmst, RSSI,
+# SNR and SF, in binary to this file on flash, using at most CAPTURE_BYTES
+# (the file and its rotated copy CAPTURE_PATH.1); read it on a PC with
+# host/capture_reader.py. None disables the capture
+CAPTURE_PATH = None
+# CAPTURE_PATH = '/flash/capture'
+CAPTURE_BYTES = 131072
+
+# only forward the frames of our own network: data uplinks by DevAddr
+# prefix, 'AABBCCDD/bits' or 'netid:NNNNNN', and join requests by JoinEUI
+# prefix in hex. Deny lists drop what they match, non empty allow lists
+# drop what they do not match; all empty forwards everything
+FILTER_DEVADDR_ALLOW = []
+# FILTER_DEVADDR_ALLOW = ['netid:000013']
+FILTER_DEVADDR_DENY = []
+FILTER_JOINEUI_ALLOW = []
+FILTER_JOINEUI_DENY = []
+
+# drop a frame heard again unchanged within this window (ms), e.g. an
+# unconfirmed uplink sent with NbTrans > 1; 0 disables the check.
+# A LoRaWAN 1.0.x confirmed uplink retried after ACK_TIMEOUT (1 to 3 s) is
+# byte identical too: dropping it means the network server never sends the
+# ACK again. Keep the window well under 1 s if confirmed uplinks are used
+DEDUP_WINDOW_MS = 0
+
+# add the gateway counters (dedup, filter, forward latency, queues, heap)
+# to the stat packets, as non standard fields that network servers ignore
+STAT_EXTENDED = False
+
+# 10 debug (every packet), 20 info, 30 warning, 40 error; the log goes to
+# the UART, or to a file on flash rotated at 32 kB when LOG_PATH is set
+LOG_LEVEL = 20
+LOG_PATH = None
+
+# answer any UDP datagram on this port with the gateway counters as JSON,
+# e.g. `echo | nc -u -w1 <gateway ip> 1701`; None disables it
+QUERY_PORT = None
+
 WIFI_SSID = 'MZ'
 WIFI_PASS = 'eatmenow'
 
@@ -20,8 +115,17 @@ WIFI_PASS = 'eatmenow'
 LORA_FREQUENCY = 868100000
 LORA_GW_DR = "SF7BW125" # DR_5
 LORA_NODE_DR = 5
+# rotate the receiver through these (frequency, SF) slots instead of only
+# listening on LORA_FREQUENCY at LORA_GW_DR, sharing RX_SCAN_CYCLE_MS by
+# how much each slot receives; None disables scanning
+RX_SCAN = None
+# RX_SCAN = [(868100000, 7), (868100000, 9), (868100000, 12), (868300000, 7), (868500000, 7)]
+RX_SCAN_CYCLE_MS = 4000
+# enforce the EU868 sub-band duty cycle limits on downlinks
+DUTY_CYCLE = True
 
 # for US915
 # LORA_FREQUENCY = 903900000
 # LORA_GW_DR = "SF10BW125" # DR_0
 # LORA_NODE_DR = 0
+# DUTY_CYCLE = False
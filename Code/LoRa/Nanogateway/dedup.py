@@ -0,0 +1,55 @@
+""" Duplicate uplink suppression for the LoPy nano gateway. """
+
+import ubinascii
+import utime
+
+DEDUP_SLOTS = 32
+DEDUP_WINDOW_MS = 5000
+
+
+class DedupCache:
+    """
+    Remembers the hash and length of the last received frames for window_ms.
+    A frame equal to one seen within the window, a reflection or an
+    unconfirmed retransmission, is reported as a duplicate.
+
+    The cache has a fixed number of slots reused round robin, a frame that
+    is evicted early only means a late duplicate gets forwarded.
+    """
+
+    def __init__(self, slots=DEDUP_SLOTS, window_ms=DEDUP_WINDOW_MS):
+        self.window_ms = window_ms
+        # crc32 truncated to 30 bits to stay a small int on MicroPython
+        self.hashes = [-1] * slots
+        self.sizes = [0] * slots
+        self.seen_ms = [0] * slots
+        self.next = 0
+
+        self.checked = 0
+        self.duplicates = 0
+
+    def duplicate(self, data):
+        """
+        Returns whether data was already seen within the window, otherwise
+        remembers it.
+        """
+
+        h = ubinascii.crc32(data) & 0x3FFFFFFF
+        n = len(data)
+        now = utime.ticks_ms()
+        self.checked += 1
+        for i in range(len(self.hashes)):
+            if self.hashes[i] == h and self.sizes[i] == n:
+                if utime.ticks_diff(now, self.seen_ms[i]) <= self.window_ms:
+                    self.duplicates += 1
+                    return True
+                # the same frame again, but long after: refresh its slot
+                self.seen_ms[i] = now
+                return False
+
+        i = self.next
+        self.hashes[i] = h
+        self.sizes[i] = n
+        self.seen_ms[i] = now
+        self.next = (i + 1) % len(self.hashes)
+        return False
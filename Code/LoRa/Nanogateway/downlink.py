@@ -0,0 +1,410 @@
+""" Class A downlink scheduler for the LoPy nano gateway. """
+
+import _thread
+import ubinascii
+import ujson
+from airtime import airtime_us
+from airtime import datr_to_sf_bw
+from semtech import TX_ERR_NONE
+from semtech import TX_ERR_TOO_LATE
+from semtech import TX_ERR_TOO_EARLY
+from semtech import TX_ERR_COLLISION_PACKET
+
+TICKS_MASK = 0xFFFFFFFF
+TICKS_HALF = 0x80000000
+
+QUEUE_SIZE = 8
+MAX_AHEAD_US = 20000000
+MIN_ALARM_US = 50
+
+CLASS_C_QUEUE_SIZE = 16
+CLASS_C_TX_PERCENT = 50
+CLASS_C_RETRY_US = 20000
+
+TX_LEAD_US = 15000
+TX_LEAD_MAX_US = 100000
+TX_HISTORY = 16
+
+
+def parse_freq_hz(raw):
+    """
+    Reads the txpk "freq" field from the raw JSON text as an integer in Hz.
+    Going through the float ujson returns loses precision on the LoPy. Only
+    plain decimal MHz is accepted, a sign or an exponent raises ValueError.
+    """
+
+    i = raw.find(b'"freq"')
+    if i < 0:
+        raise ValueError('txpk has no freq')
+    i = raw.index(b':', i) + 1
+    while raw[i] == 0x20:
+        i += 1
+    start = i
+    hz = 0
+    scale = 1000000
+    dot = False
+    while i < len(raw):
+        c = raw[i]
+        if 0x30 <= c <= 0x39:
+            if not dot:
+                hz = hz * 10 + c - 0x30
+            elif scale > 1:
+                scale //= 10
+                hz = hz * 10 + c - 0x30
+        elif c == 0x2E and not dot:
+            dot = True
+        else:
+            break
+        i += 1
+    if i == start or (i < len(raw) and raw[i] in (0x2B, 0x2D, 0x45, 0x65)):
+        raise ValueError('txpk freq is not plain decimal MHz')
+    return hz * scale
+
+
+class Txpk:
+    """
+    A downlink decoded and validated when its PULL_RESP arrives, so that
+    transmitting it only needs to set up the radio and send the payload.
+    """
+
+    def __init__(self, tmst, freq, sf, bw, datr, data):
+        self.tmst = tmst
+        self.freq = freq
+        self.sf = sf
+        self.bw = bw
+        self.datr = datr
+        self.data = data
+        self.airtime = airtime_us(sf, bw, len(data))
+        # radio specific settings, filled in by the gateway
+        self.radio_bw = None
+
+
+def decode_txpk(raw):
+    """
+    Decodes the JSON body of a PULL_RESP into a Txpk. tmst is None for an
+    immediate (class C) downlink. Raises ValueError if the txpk is invalid.
+    """
+
+    txpk = ujson.loads(raw)["txpk"]
+    if txpk.get("modu", "LORA") != "LORA":
+        raise ValueError('unsupported modulation')
+    datr = txpk["datr"]
+    sf, bw = datr_to_sf_bw(datr)
+    if not 7 <= sf <= 12 or bw not in (125, 250, 500):
+        raise ValueError('unsupported data rate ' + datr)
+    data = ubinascii.a2b_base64(txpk["data"])
+    if "size" in txpk and txpk["size"] != len(data):
+        raise ValueError('size does not match the payload')
+    tmst = None if txpk.get("imme") or "tmst" not in txpk else txpk["tmst"]
+    return Txpk(tmst, parse_freq_hz(raw), sf, bw, datr, data)
+
+
+class DownlinkScheduler:
+    """
+    Orders downlinks by their tmst and transmits them from a single alarm.
+    Every accepted downlink occupies the radio from its tmst for its time on
+    air plus a guard time; a downlink that overlaps one already queued, or
+    one being transmitted, is rejected instead of silently replacing it.
+
+    The clock, the alarm and the transmit function are passed in, so the
+    scheduler runs the same on the LoPy and on a PC:
+        clock()               current 32 bit microsecond tick, same base as tmst
+        alarm(handler, us)    one shot alarm calling handler(alarm), with cancel()
+        send(item)            transmits a downlink, called lead_us before its tmst
+    """
+
+    def __init__(self, clock, alarm, send, lead_us=15000, guard_us=10000,
+                 max_ahead_us=MAX_AHEAD_US, size=QUEUE_SIZE):
+        self.clock = clock
+        self.alarm = alarm
+        self.send = send
+        self.lead_us = lead_us
+        self.guard_us = guard_us
+        self.max_ahead_us = max_ahead_us
+        self.size = size
+
+        # sorted by tmst, entries are [tmst, airtime_us, item]
+        self.queue = []
+        self.lock = _thread.allocate_lock()
+        self.timer = None
+
+        # radio busy window of the last transmitted downlink
+        self.busy_tmst = 0
+        self.busy_us = 0
+
+        self.sent = 0
+        self.too_late = 0
+        self.too_early = 0
+        self.collisions = 0
+
+    def schedule(self, tmst, airtime, item):
+        """
+        Queues item for transmission at tmst and returns the txpk_ack error,
+        TX_ERR_NONE if it was accepted.
+        """
+
+        with self.lock:
+            now = self.clock()
+            delta = (tmst - now) & TICKS_MASK
+            if delta >= TICKS_HALF or delta < self.lead_us + MIN_ALARM_US:
+                self.too_late += 1
+                return TX_ERR_TOO_LATE
+            if delta > self.max_ahead_us:
+                self.too_early += 1
+                return TX_ERR_TOO_EARLY
+            if len(self.queue) >= self.size or self._collides(now, tmst, airtime):
+                self.collisions += 1
+                return TX_ERR_COLLISION_PACKET
+
+            i = 0
+            while i < len(self.queue) and ((self.queue[i][0] - now) & TICKS_MASK) < delta:
+                i += 1
+            self.queue.insert(i, [tmst, airtime, item])
+            if i == 0:
+                self._arm(now)
+        return TX_ERR_NONE
+
+    def cancel(self):
+        """
+        Drops all queued downlinks and stops the alarm.
+        """
+
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.queue = []
+
+    def free(self, airtime):
+        """
+        Returns whether a transmission of airtime starting now would end
+        before the next queued downlink and after the one on air.
+        """
+
+        with self.lock:
+            now = self.clock()
+            return not self._collides(now, now, airtime + self.lead_us)
+
+    def occupy(self, airtime):
+        """
+        Marks the radio busy from now for airtime, for a transmission that
+        did not go through the queue, so no downlink is accepted over it.
+        """
+
+        with self.lock:
+            self.busy_tmst = self.clock()
+            self.busy_us = airtime
+
+    def __len__(self):
+        return len(self.queue)
+
+    def _overlaps(self, now, tmst, airtime, other_tmst, other_airtime):
+        # both windows are placed on a timeline relative to now, the
+        # scheduled one starting possibly in the past while it is on air
+        a = (tmst - now) & TICKS_MASK
+        b = (other_tmst - now) & TICKS_MASK
+        if b >= TICKS_HALF:
+            b -= TICKS_MASK + 1
+        return a < b + other_airtime + self.guard_us and b < a + airtime + self.guard_us
+
+    def _collides(self, now, tmst, airtime):
+        if self.busy_us:
+            elapsed = (now - self.busy_tmst) & TICKS_MASK
+            if self.busy_us + self.guard_us < elapsed < TICKS_HALF:
+                # done, forget it before the tick counter wraps around
+                self.busy_us = 0
+            elif self._overlaps(now, tmst, airtime, self.busy_tmst, self.busy_us):
+                return True
+        for entry in self.queue:
+            if self._overlaps(now, tmst, airtime, entry[0], entry[1]):
+                return True
+        return False
+
+    def _arm(self, now):
+        # (re)arms the single alarm for the head of the queue, with the lock held
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.queue:
+            return
+        us = ((self.queue[0][0] - now) & TICKS_MASK) - self.lead_us
+        if us < MIN_ALARM_US or us >= TICKS_HALF:
+            us = MIN_ALARM_US
+        self.timer = self.alarm(self._fire, us)
+
+    def _fire(self, alarm):
+        with self.lock:
+            self.timer = None
+            if not self.queue:
+                return
+            tmst, airtime, item = self.queue.pop(0)
+            self.busy_tmst = tmst
+            self.busy_us = airtime
+            self.sent += 1
+            self._arm(self.clock())
+        self.send(item)
+
+
+class ClassCQueue:
+    """
+    First in first out queue of immediate (class C) downlinks, transmitted
+    one at a time from a single alarm. After each downlink the radio is left
+    receiving for a while, so that at most tx_percent of its time goes to
+    class C transmissions even when the server sends a burst, e.g. the
+    fragments of a firmware update.
+
+    clock, alarm and send are the same as for DownlinkScheduler, free(airtime)
+    tells whether a transmission can start now without running into a class A
+    downlink; when it cannot the head waits and is tried again later.
+    """
+
+    def __init__(self, clock, alarm, send, free=None, size=CLASS_C_QUEUE_SIZE,
+                 tx_percent=CLASS_C_TX_PERCENT, retry_us=CLASS_C_RETRY_US):
+        self.clock = clock
+        self.alarm = alarm
+        self.send = send
+        self.free = free
+        self.size = size
+        self.tx_percent = max(1, min(100, tx_percent))
+        self.retry_us = retry_us
+
+        # entries are [queued tick, airtime_us, item]
+        self.queue = []
+        self.lock = _thread.allocate_lock()
+        # the alarm stays armed while the radio rests after a downlink
+        self.timer = None
+
+        self.queued = 0
+        self.sent = 0
+        self.full = 0
+        self.deferred = 0
+        self.high_water = 0
+        self.wait_max_us = 0
+        self.wait_total_us = 0
+
+    def put(self, airtime, item):
+        """
+        Appends item to the queue and returns the txpk_ack error, TX_ERR_NONE
+        if it was accepted.
+        """
+
+        with self.lock:
+            if len(self.queue) >= self.size:
+                self.full += 1
+                return TX_ERR_COLLISION_PACKET
+            now = self.clock()
+            self.queue.append([now, airtime, item])
+            self.queued += 1
+            self.high_water = max(self.high_water, len(self.queue))
+            if self.timer is None:
+                self.timer = self.alarm(self._fire, MIN_ALARM_US)
+        return TX_ERR_NONE
+
+    def cancel(self):
+        """
+        Drops all queued downlinks and stops the alarm.
+        """
+
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.queue = []
+
+    def wait_mean_us(self):
+        return self.wait_total_us // self.sent if self.sent else 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def _fire(self, alarm):
+        with self.lock:
+            self.timer = None
+            if not self.queue:
+                return
+            now = self.clock()
+            airtime = self.queue[0][1]
+            if self.free and not self.free(airtime):
+                self.deferred += 1
+                self.timer = self.alarm(self._fire, self.retry_us)
+                return
+            queued, airtime, item = self.queue.pop(0)
+            wait = (now - queued) & TICKS_MASK
+            self.wait_total_us += wait
+            self.wait_max_us = max(self.wait_max_us, wait)
+            self.sent += 1
+            # on air for airtime, then listening for the rest of the share
+            self.timer = self.alarm(self._fire, max(MIN_ALARM_US, airtime * 100 // self.tx_percent))
+        self.send(item)
+
+
+class TxCalibration:
+    """
+    Measures how long the radio takes to start transmitting after the
+    downlink alarm fired, and how early or late each class A downlink went
+    out compared to its tmst. The radio only reports the end of the
+    transmission, its start is derived by subtracting the time on air.
+
+    In calibration mode the measured latency feeds a rolling average that
+    is used as the alarm lead time of the scheduler.
+    """
+
+    def __init__(self, lead_us=TX_LEAD_US, calibrate=True, weight=8, history=TX_HISTORY):
+        self.lead_us = lead_us
+        self.calibrate = calibrate
+        self.weight = weight
+
+        # the downlink on air, [tmst, fired, airtime]
+        self.pending = None
+
+        self.errors = [0] * history
+        self.count = 0
+        self.samples = 0
+        self.last_latency = 0
+
+    def fired(self, now, txpk):
+        """
+        Called when the alarm of a class A downlink fires.
+        """
+
+        self.pending = [txpk.tmst, now, txpk.airtime]
+
+    def tx_done(self, now):
+        """
+        Called on the radio TX_PACKET_EVENT. Returns how many microseconds
+        after its tmst the downlink started (negative when early), or None if
+        no class A downlink was being transmitted.
+        """
+
+        pending = self.pending
+        if pending is None:
+            return None
+        self.pending = None
+        tmst, fired, airtime = pending
+
+        start = (now - airtime) & TICKS_MASK
+        latency = (start - fired) & TICKS_MASK
+        error = (start - tmst) & TICKS_MASK
+        if error >= TICKS_HALF:
+            error -= TICKS_MASK + 1
+
+        self.errors[self.count % len(self.errors)] = error
+        self.count += 1
+
+        if latency < TX_LEAD_MAX_US:
+            self.last_latency = latency
+            self.samples += 1
+            if self.calibrate:
+                self.lead_us += (latency - self.lead_us) // self.weight
+        return error
+
+    def error_stats(self):
+        """
+        Returns (min, mean, max) of the timing errors of the last downlinks.
+        """
+
+        n = min(self.count, len(self.errors))
+        if not n:
+            return (0, 0, 0)
+        errors = self.errors[:n]
+        return (min(errors), sum(errors) // n, max(errors))
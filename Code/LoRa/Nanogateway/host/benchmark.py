@@ -0,0 +1,175 @@
+""" Benchmarks the nano gateway on a PC against the local network server.
+
+Usage: python3 benchmark.py [--pattern poisson|periodic|bursts] [--rate FPS]
+                            [--duration S] [--nodes N] [--sf LIST]
+                            [--downlinks SHARE] [--ticks-cpu TICKS]
+                            [--config KEY=VALUE ...]
+
+The unmodified NanoGateway runs on the stand-ins of host/upy and forwards
+to semtech_server.py running in the same process. Uplinks generated by
+traffic.py are put on the emulated air; a share of them is answered with a
+class A downlink one second after the uplink, like RX1. Reported are:
+    forwarded frames per second and the forward latency, from the end of the
+        frame on the air until the server received it
+    the drop rate, frames the radio received but the server never got
+    the downlink timing error, when the radio started transmitting compared
+        to the tmst requested, and the txpk_ack errors
+"""
+
+import argparse
+import ast
+import asyncio
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, 'upy'))
+
+import network  # noqa: E402
+import traffic  # noqa: E402
+import utime  # noqa: E402
+from nanogateway import NanoGateway  # noqa: E402
+from semtech_server import serve  # noqa: E402
+
+GATEWAY_ID = '240AC4FFFE000102'
+RX1_DELAY_US = 1000000
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    if not values:
+        return [0] * len(ps)
+    values = sorted(values)
+    return [values[min(len(values) - 1, p * len(values) // 100)] for p in ps]
+
+
+class ServerThread:
+    """
+    Runs the network server stand-in on its own event loop thread.
+    """
+
+    def __init__(self, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.kwargs = kwargs
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.transport, self.server = self.loop.run_until_complete(serve('127.0.0.1', 0, **self.kwargs))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def run(args, config):
+    frames = traffic.generate(args.pattern, args, args.seed)
+    srv = ServerThread(drop_acks=args.drop_acks, ack_delay_ms=args.ack_delay)
+    server = srv.server
+
+    gw = NanoGateway(id=GATEWAY_ID, frequency=868100000, datarate='SF7BW125', ssid='host', password='',
+                     server='127.0.0.1', port=srv.port, **config)
+
+    # payload -> time it ended on the air, and downlink payload -> tmst
+    injected = {}
+    downlinks = {}
+    latencies = []
+    counter = [0]
+
+    def on_uplink(uplink):
+        sent = injected.get(uplink.data)
+        if sent is not None:
+            latencies.append((uplink.received - sent) * 1000)
+        counter[0] += 1
+        if args.downlinks and (counter[0] * args.downlinks) % 1 < args.downlinks:
+            data = b'\x60' + counter[0].to_bytes(4, 'little') + bytes(8)
+            tmst = (uplink.tmst + RX1_DELAY_US) & 0xFFFFFFFF
+            downlinks[data] = tmst
+            server.send_downlink(GATEWAY_ID, data, tmst=tmst, freq=uplink.rxpk['freq'], datr=uplink.rxpk['datr'])
+
+    server.on_uplink = on_uplink
+    if args.ticks_cpu is not None:
+        utime.set_ticks_cpu(args.ticks_cpu)
+    gw.start()
+    # let the first PULL_DATA register the gateway for downlinks
+    time.sleep(0.5)
+
+    radio = network.radio
+    radio.rx_log = []
+    start = time.monotonic()
+    for frame in frames:
+        wait = start + frame.at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        injected.setdefault(frame.data, time.monotonic())
+        radio.inject(frame.data, sf=frame.sf, rssi=frame.rssi, snr=frame.snr)
+    elapsed = time.monotonic() - start
+    time.sleep(2)
+    gw.stop()
+    srv.stop()
+
+    # downlink timing, the radio records the tick at which it started
+    errors = []
+    for tick, freq, sf, data in radio.transmitted:
+        tmst = downlinks.get(data)
+        if tmst is not None:
+            error = (tick - tmst) & 0xFFFFFFFF
+            errors.append(error - (1 << 32) if error >= 1 << 31 else error)
+    ack_errors = {}
+    for error in server.tx_acks.values():
+        ack_errors[error] = ack_errors.get(error, 0) + 1
+
+    forwarded = set(uplink.data for uplink in server.uplinks)
+    heard = set(radio.rx_log)
+    stats = gw.stats()
+    print()
+    print('pattern {}, {} frames in {:.1f} s, {} unique'.format(args.pattern, len(frames), elapsed, len(injected)))
+    print('radio received {} missed on air {}'.format(radio.received, radio.missed))
+    print('server got {} unique frames, {:.1f} frames/s, drop rate {:.2%}'.format(
+        len(forwarded), len(forwarded) / elapsed, 1 - len(heard & forwarded) / max(1, len(heard))))
+    print('forward latency p50/p90/p99 {} ms'.format(['{:.1f}'.format(v) for v in percentiles(latencies)]))
+    print('downlinks requested {} transmitted {}, txpk_ack {}'.format(len(downlinks), len(errors), ack_errors))
+    if errors:
+        print('downlink timing error min/p50/max {}/{}/{} us'.format(min(errors), percentiles(errors)[0], max(errors)))
+    print('gateway: {}'.format({key: stats[key] for key in ('queues', 'drops', 'heap')}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the nano gateway on emulated hardware')
+    parser.add_argument('--pattern', default='poisson', choices=sorted(traffic.PATTERNS))
+    parser.add_argument('--rate', type=float, default=10.0, help='average frames per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of traffic')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--size', type=int, default=20, help='PHYPayload bytes')
+    parser.add_argument('--sf', default='7', help='SFs of the nodes, empty for the ADR mix')
+    parser.add_argument('--retransmit', type=float, default=0.0, help='share of periodic frames sent twice')
+    parser.add_argument('--burst-every', type=float, default=5.0)
+    parser.add_argument('--burst-size', type=int, default=20)
+    parser.add_argument('--burst-spread', type=float, default=0.5)
+    parser.add_argument('--downlinks', type=float, default=0.1, help='share of uplinks answered with a downlink')
+    parser.add_argument('--drop-acks', type=float, default=0.0)
+    parser.add_argument('--ack-delay', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--ticks-cpu', type=lambda v: int(v, 0), default=None,
+                        help='tmst clock at the start, e.g. 0xFFE00000 to cross its wraparound')
+    parser.add_argument('--config', nargs='*', default=[], metavar='KEY=VALUE')
+    args = parser.parse_args()
+
+    config = {'stat_extended': True}
+    for item in args.config:
+        key, value = item.split('=', 1)
+        config[key] = ast.literal_eval(value)
+    run(args, config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+""" Reads the binary radio captures of the nano gateway.
+
+Usage: python3 capture_reader.py CAPTURE [CAPTURE ...] [--pcap OUT] [--npz OUT]
+
+A capture is the CAPTURE_PATH file copied from the LoPy flash, give the
+rotated CAPTURE_PATH.1 first to keep the frames in order. Without options
+the frames are listed. --pcap writes them as a pcap file with LoRaTap
+headers (link type 270), which Wireshark decodes down to the LoRaWAN MAC
+layer. --npz writes NumPy arrays, one per field plus the payloads padded
+to 255 bytes, loadable with numpy.load(OUT).
+
+Records torn by a power loss at the end of a file are ignored, a record
+with a bad magic ends the file.
+"""
+
+import argparse
+import binascii
+import os
+import struct
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, 'upy'))
+
+from capture import FILE_HEADER  # noqa: E402
+from capture import FILE_HEADER_LEN  # noqa: E402
+from capture import FILE_MAGIC  # noqa: E402
+from capture import RECORD_HEADER  # noqa: E402
+from capture import RECORD_MAGIC  # noqa: E402
+
+LINKTYPE_LORATAP = 270
+# LoRaTap version 0: version, padding, length, then big endian frequency,
+# bandwidth, SF, packet/max/current RSSI, SNR and sync word
+LORATAP_HEADER = '>BBHIBBBBBBB'
+LORATAP_HEADER_LEN = 15
+LORAWAN_SYNC_WORD = 0x34
+
+PAYLOAD_MAX = 255
+
+
+class Record:
+
+    def __init__(self, secs, usecs, tmst, freq, sf, bw_khz, rssi, snr, data):
+        self.secs = secs
+        self.usecs = usecs
+        self.tmst = tmst
+        self.freq = freq
+        self.sf = sf
+        self.bw_khz = bw_khz
+        self.rssi = rssi
+        self.snr = snr
+        self.data = data
+
+
+def read(path):
+    """
+    Yields the records of one capture file.
+    """
+
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER_LEN)
+        if len(header) < FILE_HEADER_LEN:
+            return
+        magic, version, record_len = struct.unpack(FILE_HEADER, header)
+        if magic != FILE_MAGIC:
+            raise ValueError('{} is not a nano gateway capture'.format(path))
+        while True:
+            header = f.read(record_len)
+            if len(header) < record_len:
+                return
+            magic, sf, length, secs, usecs, tmst, freq, rssi, snr, bw = struct.unpack(
+                RECORD_HEADER, header[:struct.calcsize(RECORD_HEADER)])
+            if magic != RECORD_MAGIC:
+                print('{}: lost framing at offset {}'.format(path, f.tell() - record_len), file=sys.stderr)
+                return
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield Record(secs, usecs, tmst, freq, sf, bw * 125, rssi, snr / 4, data)
+
+
+def write_pcap(records, out):
+    """
+    Writes the records to out, a binary file, as pcap with LoRaTap headers.
+    Returns the number of frames written.
+    """
+
+    out.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, LINKTYPE_LORATAP))
+    n = 0
+    for r in records:
+        # LoRaTap RSSI is an offset from -139 dBm, SNR is in quarter dB
+        rssi = max(0, min(255, r.rssi + 139))
+        tap = struct.pack(LORATAP_HEADER, 0, 0, LORATAP_HEADER_LEN, r.freq, r.bw_khz // 125, r.sf,
+                          rssi, rssi, rssi, int(r.snr * 4) & 0xFF, LORAWAN_SYNC_WORD)
+        size = len(tap) + len(r.data)
+        out.write(struct.pack('<IIII', r.secs, r.usecs, size, size))
+        out.write(tap)
+        out.write(r.data)
+        n += 1
+    return n
+
+
+def to_numpy(records):
+    """
+    Returns a dict of NumPy arrays, one per record field, the payloads as a
+    uint8 matrix padded with zeros next to their lengths.
+    """
+
+    import numpy as np
+
+    records = list(records)
+    payload = np.zeros((len(records), PAYLOAD_MAX), dtype=np.uint8)
+    for i, r in enumerate(records):
+        payload[i, :len(r.data)] = np.frombuffer(r.data[:PAYLOAD_MAX], dtype=np.uint8)
+    return {
+        'time': np.array([r.secs + r.usecs / 1e6 for r in records], dtype=np.float64),
+        'tmst': np.array([r.tmst for r in records], dtype=np.uint32),
+        'freq': np.array([r.freq for r in records], dtype=np.uint32),
+        'sf': np.array([r.sf for r in records], dtype=np.uint8),
+        'bw_khz': np.array([r.bw_khz for r in records], dtype=np.uint16),
+        'rssi': np.array([r.rssi for r in records], dtype=np.int16),
+        'snr': np.array([r.snr for r in records], dtype=np.float32),
+        'size': np.array([len(r.data) for r in records], dtype=np.uint16),
+        'payload': payload,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read nano gateway radio captures')
+    parser.add_argument('captures', nargs='+', help='capture files, oldest first')
+    parser.add_argument('--pcap', help='write a LoRaTap pcap file')
+    parser.add_argument('--npz', help='write NumPy arrays')
+    args = parser.parse_args()
+
+    records = [r for path in args.captures for r in read(path)]
+    if args.pcap:
+        with open(args.pcap, 'wb') as out:
+            print('{} frames written to {}'.format(write_pcap(records, out), args.pcap))
+    if args.npz:
+        try:
+            import numpy as np
+        except ImportError:
+            sys.exit('--npz needs NumPy')
+        np.savez(args.npz, **to_numpy(records))
+        print('{} frames written to {}'.format(len(records), args.npz))
+    if not args.pcap and not args.npz:
+        for r in records:
+            print('{}.{:06d} tmst {:>10} {:.3f} MHz SF{} BW{} rssi {} snr {:.2f} {}'.format(
+                r.secs, r.usecs, r.tmst, r.freq / 1e6, r.sf, r.bw_khz, r.rssi, r.snr,
+                binascii.hexlify(r.data).decode()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+""" Replays PULL_RESP arrivals through the downlink scheduler on a PC.
+
+Usage: python3 downlink_replay.py [scenario]
+
+Each scenario line is `recv_us tmst datr size [txpk_ack]`, the time the
+PULL_RESP reached the gateway, the txpk tmst, data rate and payload size, and
+optionally the txpk_ack error expected. Lines starting with # are ignored.
+Without a scenario file a built-in one is replayed. The scheduler runs against
+a virtual clock, so the txpk_ack every downlink would get and the time it would
+be handed to the radio are printed without any hardware. The exit status is 1
+when a txpk_ack differs from the expected one; test_downlink_replay.py runs
+the built-in scenario under pytest.
+"""
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, 'upy'))
+
+from airtime import airtime_us  # noqa: E402
+from airtime import datr_to_sf_bw  # noqa: E402
+from downlink import DownlinkScheduler  # noqa: E402
+
+SCENARIO = """
+# two RX1 downlinks 200 ms apart, the second one used to replace the first
+1000000 2000000 SF7BW125 12 NONE
+1200000 2200000 SF7BW125 12 NONE
+# overlaps the first one
+1300000 2010000 SF7BW125 33 COLLISION_PACKET
+# RX2 of a join accept at SF12, both fit
+1400000 7000000 SF12BW125 33 NONE
+# arrives after its transmit time
+2500000 2400000 SF7BW125 12 TOO_LATE
+# tmst more than 20 s ahead
+2600000 30000000 SF9BW125 12 TOO_EARLY
+# server answers late, less than the TX lead time before tmst
+7500000 7510000 SF9BW125 12 TOO_LATE
+"""
+
+
+class VirtualClock:
+    """
+    Microsecond tick counter and one shot alarms driven by the replay loop.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.alarms = []
+
+    def ticks(self):
+        return self.now & 0xFFFFFFFF
+
+    def alarm(self, handler, us):
+        alarm = VirtualAlarm(self, handler, self.now + us)
+        self.alarms.append(alarm)
+        return alarm
+
+    def advance(self, until):
+        # fire every alarm due up to `until`, in order
+        while True:
+            due = [a for a in self.alarms if a.at <= until]
+            if not due:
+                break
+            alarm = min(due, key=lambda a: a.at)
+            self.alarms.remove(alarm)
+            self.now = alarm.at
+            alarm.handler(alarm)
+        self.now = until
+
+
+class VirtualAlarm:
+
+    def __init__(self, clock, handler, at):
+        self.clock = clock
+        self.handler = handler
+        self.at = at
+
+    def cancel(self):
+        if self in self.clock.alarms:
+            self.clock.alarms.remove(self)
+
+
+class Replay:
+    """
+    The outcome of a scenario: acks holds one (recv_us, tmst, datr, size,
+    airtime, txpk_ack, expected) per downlink, expected being None when the
+    line gave none, and sent the (sent_us, tmst) of every transmission.
+    """
+
+    def __init__(self, scheduler, acks, sent):
+        self.scheduler = scheduler
+        self.acks = acks
+        self.sent = sent
+
+    def mismatches(self):
+        return [a for a in self.acks if a[6] is not None and a[5] != a[6]]
+
+
+def replay(lines):
+    """
+    Runs the scenario lines through a DownlinkScheduler, returns a Replay.
+    """
+
+    clock = VirtualClock()
+    sent = []
+    scheduler = DownlinkScheduler(
+        clock=clock.ticks,
+        alarm=clock.alarm,
+        send=lambda item: sent.append((clock.now, item))
+    )
+
+    acks = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        recv_us, tmst, datr, size = fields[:4]
+        expected = fields[4] if len(fields) > 4 else None
+        recv_us, tmst, size = int(recv_us), int(tmst), int(size)
+        clock.advance(recv_us)
+        sf, bw = datr_to_sf_bw(datr)
+        airtime = airtime_us(sf, bw, size)
+        error = scheduler.schedule(tmst, airtime, tmst)
+        acks.append((recv_us, tmst, datr, size, airtime, error, expected))
+    clock.advance(clock.now + scheduler.max_ahead_us)
+    return Replay(scheduler, acks, sent)
+
+
+def report(result):
+    print('{:>10} {:>10} {:>10} {:>9} {:>5}  {}'.format('recv_us', 'tmst', 'datr', 'airtime', 'size', 'txpk_ack'))
+    for recv_us, tmst, datr, size, airtime, error, expected in result.acks:
+        note = '' if expected is None or expected == error else '  expected ' + expected
+        print('{:>10} {:>10} {:>10} {:>9} {:>5}  {}{}'.format(recv_us, tmst, datr, airtime, size, error, note))
+
+    print()
+    print('{:>10} {:>10} {:>8}'.format('tmst', 'sent_us', 'lead_us'))
+    for at, tmst in result.sent:
+        print('{:>10} {:>10} {:>8}'.format(tmst, at, tmst - at))
+    print()
+    scheduler = result.scheduler
+    print('sent {} too late {} too early {} collisions {}'.format(
+        scheduler.sent, scheduler.too_late, scheduler.too_early, scheduler.collisions))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            result = replay(f.readlines())
+    else:
+        result = replay(SCENARIO.splitlines())
+    report(result)
+    if result.mismatches():
+        print('{} txpk_ack differ from the expected ones'.format(len(result.mismatches())))
+        sys.exit(1)
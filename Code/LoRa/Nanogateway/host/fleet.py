@@ -0,0 +1,274 @@
+""" Fleet scale simulation of nano gateways sharing one backhaul and server.
+
+Usage: python3 fleet.py [--gateways N] [--duration S] [--rate FPS]
+                        [--backhaul-kbps K] [--server-pps P] [--push-window-ms MS]
+
+Hundreds of gateways cannot each run their four NanoGateway threads in one
+process, so every virtual gateway here is an asyncio task speaking the same
+protocol with the gateway's own building blocks: PacketBuilder, write_rxpk
+and write_stat for the datagrams, AckTracker for the PUSH_ACKs, the same
+push window batching and stat and PULL_DATA timers. Each gateway has its
+own EUI, UDP socket, timer phases and Poisson uplink traffic from its own
+end devices; some gateways can be made busier than the others.
+
+All of them send through one shared backhaul link with a given capacity and
+buffer, to a network server stand-in that processes a given number of
+packets per second from a bounded queue. Reported are the aggregate
+throughput, the queueing delay in the backhaul and the server, and the ack
+loss seen by the gateways.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, 'upy'))
+
+import traffic  # noqa: E402
+from acks import AckTracker  # noqa: E402
+from semtech import PacketBuilder  # noqa: E402
+from semtech import write_rxpk  # noqa: E402
+from semtech import write_stat  # noqa: E402
+from semtech_server import PULL_DATA  # noqa: E402
+from semtech_server import PUSH_ACK  # noqa: E402
+from semtech_server import PUSH_DATA  # noqa: E402
+from semtech_server import SemtechServer  # noqa: E402
+
+RTC_NOW = (2020, 1, 1, 0, 0, 0, 0, None)
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    if not values:
+        return [0] * len(ps)
+    values = sorted(values)
+    return [values[min(len(values) - 1, p * len(values) // 100)] for p in ps]
+
+
+class Backhaul:
+    """
+    The shared uplink: packets leave one after the other at the link rate,
+    a packet that would wait more than buffer_ms is dropped.
+    """
+
+    def __init__(self, kbps, buffer_ms):
+        self.bytes_per_s = kbps * 1000 / 8
+        self.buffer_s = buffer_ms / 1000
+        self.free_at = 0.0
+        self.delays = []
+        self.sent = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def send(self, transport, packet, addr):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self.free_at)
+        if start - now > self.buffer_s:
+            self.dropped += 1
+            return
+        self.free_at = start + len(packet) / self.bytes_per_s
+        self.delays.append((self.free_at - now) * 1000)
+        self.sent += 1
+        self.bytes += len(packet)
+        loop.call_at(self.free_at, transport.sendto, bytes(packet), addr)
+
+
+class FleetServer(SemtechServer):
+    """
+    Network server with a bounded input queue served at pps packets per
+    second, packets arriving to a full queue are lost.
+    """
+
+    def __init__(self, pps, queue_size, **kwargs):
+        super().__init__(**kwargs)
+        self.pps = pps
+        self.queue = asyncio.Queue(queue_size)
+        self.delays = []
+        self.queue_dropped = 0
+        self.worker = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.worker = asyncio.ensure_future(self._serve())
+
+    def datagram_received(self, data, addr):
+        try:
+            self.queue.put_nowait((time.monotonic(), data, addr))
+        except asyncio.QueueFull:
+            self.queue_dropped += 1
+
+    async def _serve(self):
+        while True:
+            received, data, addr = await self.queue.get()
+            self.delays.append((time.monotonic() - received) * 1000)
+            super().datagram_received(data, addr)
+            if self.pps:
+                await asyncio.sleep(1 / self.pps)
+
+
+class VirtualGateway(asyncio.DatagramProtocol):
+    """
+    One simulated gateway, see the module documentation.
+    """
+
+    def __init__(self, eui, rate, nodes, backhaul, server_addr, args, rnd):
+        self.eui = eui
+        self.rate = rate
+        self.nodes = nodes
+        self.backhaul = backhaul
+        self.server_addr = server_addr
+        self.args = args
+        self.rnd = rnd
+        self.transport = None
+
+        self.pkt = PacketBuilder(eui)
+        self.acks = AckTracker(slots=64, timeout_ms=args.ack_timeout_ms)
+        self.batch = []
+        self.flush_handle = None
+        self.uplinks = 0
+        self.rxfw = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 4 and data[3] == PUSH_ACK:
+            self.acks.ack((data[1] << 8) | data[2])
+
+    def error_received(self, exc):
+        pass
+
+    async def run(self, duration):
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration
+        # every gateway boots at a different time, so its timers have their own phase
+        loop.call_later(self.rnd.uniform(0, self.args.stat_s), self._stat_timer)
+        loop.call_later(self.rnd.uniform(0, self.args.pull_s), self._pull_timer)
+        while True:
+            wait = self.rnd.expovariate(self.rate)
+            if loop.time() + wait >= end:
+                break
+            await asyncio.sleep(wait)
+            self._receive(self.rnd.choice(self.nodes).frame(0), loop)
+            self.acks.expired()
+        self._flush()
+
+    def _receive(self, frame, loop):
+        self.uplinks += 1
+        tmst = int(loop.time() * 1000000) & 0xFFFFFFFF
+        self.batch.append((tmst, frame))
+        if len(self.batch) >= self.args.push_batch_max or self.args.push_window_ms <= 0:
+            self._flush()
+        elif len(self.batch) == 1:
+            self.flush_handle = loop.call_later(self.args.push_window_ms / 1000, self._flush)
+
+    def _flush(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.batch:
+            return
+        token = self.pkt.begin(PUSH_DATA)
+        self.pkt.append(b'{"rxpk":[')
+        for i, (tmst, frame) in enumerate(self.batch):
+            if i:
+                self.pkt.append(b',')
+            write_rxpk(self.pkt, RTC_NOW, tmst, 868100000, b'SF%dBW125' % frame.sf, frame.rssi, frame.snr, frame.data)
+        self.pkt.append(b']}')
+        self.rxfw += len(self.batch)
+        self.batch = []
+        self.acks.sent(token)
+        self.backhaul.send(self.transport, self.pkt.packet(), self.server_addr)
+
+    def _stat_timer(self):
+        token = self.pkt.begin(PUSH_DATA)
+        write_stat(self.pkt, RTC_NOW, self.uplinks, self.uplinks, self.rxfw, self.acks.ackr(), 0, 0)
+        self.acks.sent(token)
+        self.backhaul.send(self.transport, self.pkt.packet(), self.server_addr)
+        asyncio.get_running_loop().call_later(self.args.stat_s, self._stat_timer)
+
+    def _pull_timer(self):
+        self.pkt.begin(PULL_DATA)
+        self.backhaul.send(self.transport, self.pkt.packet(), self.server_addr)
+        asyncio.get_running_loop().call_later(self.args.pull_s, self._pull_timer)
+
+
+async def simulate(args):
+    loop = asyncio.get_running_loop()
+    rnd = random.Random(args.seed)
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: FleetServer(args.server_pps, args.server_queue), local_addr=('127.0.0.1', 0))
+    server_addr = transport.get_extra_info('sockname')
+    backhaul = Backhaul(args.backhaul_kbps, args.backhaul_buffer_ms)
+
+    gateways = []
+    for i in range(args.gateways):
+        eui = '240AC4FFFE{:06X}'.format(i)
+        # a share of the gateways sits at busy sites
+        rate = args.rate * (args.hot_factor if rnd.random() < args.hot_share else 1)
+        nodes = traffic.make_nodes(args.nodes, rnd, size=args.size)
+        gw = VirtualGateway(eui, rate, nodes, backhaul, server_addr, args, random.Random(rnd.random()))
+        await loop.create_datagram_endpoint(lambda gw=gw: gw, remote_addr=None, local_addr=('127.0.0.1', 0))
+        gateways.append(gw)
+
+    start = loop.time()
+    await asyncio.gather(*(gw.run(args.duration) for gw in gateways))
+    elapsed = loop.time() - start
+    # let the last packets and their acks arrive, then count what never was acked
+    await asyncio.sleep(max(1.0, args.ack_timeout_ms / 1000 * 2))
+    for gw in gateways:
+        gw.acks.expired()
+        gw.acks.timeout_ms = 0
+        gw.acks.expired()
+    transport.close()
+    return gateways, backhaul, server, elapsed
+
+
+def report(args, gateways, backhaul, server, elapsed):
+    uplinks = sum(gw.uplinks for gw in gateways)
+    pushed = sum(gw.acks.pushed for gw in gateways)
+    acked = sum(gw.acks.acked for gw in gateways)
+    lost = sum(gw.acks.lost for gw in gateways)
+    print('{} gateways, {:.1f} s, {} uplinks, {:.1f} uplinks/s'.format(len(gateways), elapsed, uplinks, uplinks / elapsed))
+    print('backhaul: {} packets, {:.1f} packets/s, {:.1f} kbit/s of {} kbit/s, {} dropped'.format(
+        backhaul.sent, backhaul.sent / elapsed, backhaul.bytes * 8 / 1000 / elapsed, args.backhaul_kbps, backhaul.dropped))
+    print('backhaul queueing delay p50/p90/p99/max {} ms'.format(
+        ['{:.1f}'.format(v) for v in percentiles(backhaul.delays) + [max(backhaul.delays or [0])]]))
+    print('server: {} PUSH_DATA, {} PULL_DATA, {} lost in its queue'.format(
+        server.push_data, server.pull_data, server.queue_dropped))
+    print('server queueing delay p50/p90/p99/max {} ms'.format(
+        ['{:.1f}'.format(v) for v in percentiles(server.delays) + [max(server.delays or [0])]]))
+    print('PUSH_DATA {} acked {} lost {}, ack loss {:.2%}'.format(pushed, acked, lost, lost / max(1, pushed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of nano gateways')
+    parser.add_argument('--gateways', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--rate', type=float, default=0.5, help='uplinks per second per gateway')
+    parser.add_argument('--hot-share', type=float, default=0.1, help='share of busy gateways')
+    parser.add_argument('--hot-factor', type=float, default=10.0, help='traffic multiplier of busy gateways')
+    parser.add_argument('--nodes', type=int, default=20, help='end devices per gateway')
+    parser.add_argument('--size', type=int, default=20, help='PHYPayload bytes')
+    parser.add_argument('--push-window-ms', type=int, default=50)
+    parser.add_argument('--push-batch-max', type=int, default=8)
+    parser.add_argument('--stat-s', type=float, default=60.0)
+    parser.add_argument('--pull-s', type=float, default=25.0)
+    parser.add_argument('--ack-timeout-ms', type=int, default=2000)
+    parser.add_argument('--backhaul-kbps', type=float, default=1000.0)
+    parser.add_argument('--backhaul-buffer-ms', type=float, default=500.0)
+    parser.add_argument('--server-pps', type=float, default=0, help='server packets per second, 0 for unlimited')
+    parser.add_argument('--server-queue', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    report(args, *asyncio.run(simulate(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+""" Runs the unmodified NanoGateway on a PC against emulated LoPy hardware.
+
+Usage: python3 run_gateway.py [--server HOST:PORT] [--frames N] [--rate FPS]
+                              [--sf LIST] [--config KEY=VALUE ...]
+
+The MicroPython modules the gateway imports are replaced by the stand-ins in
+host/upy: the LoRa radio, WLAN, the RTC and Timer.Alarm are emulated, the
+UDP sockets are real ones. Frames are injected into the radio at the given
+rate, spread over the SFs listed, and the gateway counters are printed at
+the end. Extra constructor arguments can be given as KEY=VALUE, the value
+being a Python literal, e.g. --config push_window_ms=50 dedup_window_ms=500.
+"""
+
+import argparse
+import ast
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, 'upy'))
+
+import network  # noqa: E402
+from nanogateway import NanoGateway  # noqa: E402
+
+GATEWAY_ID = '240AC4FFFE000102'
+
+
+def uplink(rnd, size):
+    """
+    Returns a random LoRaWAN unconfirmed data uplink of a TTN DevAddr.
+    """
+
+    devaddr = bytes([rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), 0x26])
+    fcnt = rnd.randrange(65536).to_bytes(2, 'little')
+    payload = bytes(rnd.randrange(256) for i in range(max(0, size - 12)))
+    return b'\x40' + devaddr + b'\x00' + fcnt + payload + bytes(4)
+
+
+def inject(radio, frames, rate, sfs, rnd, size=20):
+    """
+    Puts frames on the air at the given average rate, with Poisson arrivals.
+    Returns how long the injection took.
+    """
+
+    start = time.monotonic()
+    due = start
+    for i in range(frames):
+        due += rnd.expovariate(rate)
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        radio.inject(uplink(rnd, size), sf=rnd.choice(sfs), rssi=rnd.randint(-120, -40),
+                     snr=round(rnd.uniform(-15, 10), 1))
+    return time.monotonic() - start
+
+
+def make_gateway(server, config):
+    host, port = server.rsplit(':', 1)
+    kwargs = dict(
+        id=GATEWAY_ID,
+        frequency=868100000,
+        datarate='SF7BW125',
+        ssid='host',
+        password='',
+        server=host,
+        port=int(port),
+        stat_extended=True
+    )
+    kwargs.update(config)
+    return NanoGateway(**kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the nano gateway on emulated hardware')
+    parser.add_argument('--server', default='127.0.0.1:1700')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=10.0, help='frames per second')
+    parser.add_argument('--sf', default='7', help='comma separated SFs of the injected frames')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config', nargs='*', default=[], metavar='KEY=VALUE')
+    args = parser.parse_args()
+
+    config = {}
+    for item in args.config:
+        key, value = item.split('=', 1)
+        config[key] = ast.literal_eval(value)
+
+    gw = make_gateway(args.server, config)
+    gw.start()
+    elapsed = inject(network.radio, args.frames, args.rate, [int(sf) for sf in args.sf.split(',')],
+                     random.Random(args.seed))
+    time.sleep(1)
+    gw.stop()
+
+    radio = network.radio
+    stats = gw.stats()
+    print()
+    print('injected {} frames in {:.1f} s, radio received {} missed {}'.format(
+        args.frames, elapsed, radio.received, radio.missed))
+    print('forwarded {} frames, {:.1f} frames/s'.format(stats['rx']['rxfw'], stats['rx']['rxfw'] / elapsed))
+    for key in ('forward_ms', 'queues', 'drops', 'filter', 'radio', 'heap', 'udp'):
+        print('{}: {}'.format(key, stats[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+""" Local Semtech UDP network server stand-in, for testing without TTN.
+
+Usage: python3 semtech_server.py [--port 1700] [--drop-acks P] [--ack-delay MS]
+
+Acknowledges PUSH_DATA and PULL_DATA like a network server, logs every
+packet and keeps the received uplinks with their arrival time. Downlinks can
+be sent with SemtechServer.send_downlink() to the gateway that last sent a
+PULL_DATA, their TX_ACK errors are collected. Used on its own it is a
+network server to point a real LoPy at, the benchmark runs it in process.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+
+PUSH_DATA = 0
+PUSH_ACK = 1
+PULL_DATA = 2
+PULL_RESP = 3
+PULL_ACK = 4
+TX_ACK = 5
+
+
+class Uplink:
+
+    def __init__(self, received, gateway, rxpk):
+        self.received = received
+        self.gateway = gateway
+        self.rxpk = rxpk
+        self.data = base64.b64decode(rxpk['data'])
+        self.tmst = rxpk['tmst']
+
+
+class SemtechServer(asyncio.DatagramProtocol):
+    """
+    asyncio protocol of the server. on_uplink, if set, is called with every
+    Uplink received, from the event loop.
+    """
+
+    def __init__(self, drop_acks=0.0, ack_delay_ms=0, verbose=False, seed=None):
+        self.drop_acks = drop_acks
+        self.ack_delay_ms = ack_delay_ms
+        self.verbose = verbose
+        self.rnd = random.Random(seed)
+        self.transport = None
+        self.on_uplink = None
+
+        # gateway EUI -> address of its last PULL_DATA
+        self.gateways = {}
+        self.uplinks = []
+        self.stats = []
+        self.tx_acks = {}
+        self.token = int.from_bytes(os.urandom(2), 'big')
+
+        self.push_data = 0
+        self.pull_data = 0
+        self.acks_dropped = 0
+        self.malformed = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        now = time.monotonic()
+        if len(data) < 4 or data[0] not in (1, 2):
+            self.malformed += 1
+            return
+        ptype = data[3]
+        if ptype == PUSH_DATA and len(data) >= 12:
+            self.push_data += 1
+            gateway = data[4:12].hex().upper()
+            self._ack(data, PUSH_ACK, addr)
+            try:
+                body = json.loads(data[12:])
+            except ValueError:
+                self.malformed += 1
+                return
+            for rxpk in body.get('rxpk', ()):
+                uplink = Uplink(now, gateway, rxpk)
+                self.uplinks.append(uplink)
+                self._log('PUSH_DATA from {}: tmst {} {} {} bytes', gateway, uplink.tmst, rxpk.get('datr'), len(uplink.data))
+                if self.on_uplink:
+                    self.on_uplink(uplink)
+            if 'stat' in body:
+                self.stats.append((now, gateway, body['stat']))
+                self._log('stat from {}: {}', gateway, body['stat'])
+        elif ptype == PULL_DATA and len(data) >= 12:
+            self.pull_data += 1
+            gateway = data[4:12].hex().upper()
+            self.gateways[gateway] = addr
+            self._ack(data, PULL_ACK, addr)
+        elif ptype == TX_ACK:
+            token = (data[1] << 8) | data[2]
+            error = 'NONE'
+            if len(data) > 12:
+                try:
+                    error = json.loads(data[12:])['txpk_ack']['error']
+                except (ValueError, KeyError):
+                    self.malformed += 1
+            self.tx_acks[token] = error
+            self._log('TX_ACK {}: {}', token, error)
+        else:
+            self.malformed += 1
+
+    def send_downlink(self, gateway, data, tmst=None, freq=869.525, datr='SF9BW125', powe=14):
+        """
+        Sends a PULL_RESP to a gateway, class A at tmst or immediately when
+        tmst is None. Returns the token its TX_ACK will carry, or None if the
+        gateway never sent a PULL_DATA.
+        """
+
+        addr = self.gateways.get(gateway)
+        if addr is None:
+            return None
+        txpk = {'freq': freq, 'rfch': 0, 'powe': powe, 'modu': 'LORA', 'datr': datr,
+                'codr': '4/5', 'ipol': True, 'size': len(data), 'data': base64.b64encode(data).decode()}
+        if tmst is None:
+            txpk['imme'] = True
+        else:
+            txpk['tmst'] = tmst
+        self.token = (self.token + 1) & 0xFFFF
+        packet = bytes([2, self.token >> 8, self.token & 0xFF, PULL_RESP]) + json.dumps({'txpk': txpk}).encode()
+        self.transport.sendto(packet, addr)
+        return self.token
+
+    def _ack(self, data, ptype, addr):
+        if self.drop_acks and self.rnd.random() < self.drop_acks:
+            self.acks_dropped += 1
+            return
+        ack = bytes([data[0], data[1], data[2], ptype])
+        if self.ack_delay_ms:
+            asyncio.get_event_loop().call_later(self.ack_delay_ms / 1000, self.transport.sendto, ack, addr)
+        else:
+            self.transport.sendto(ack, addr)
+
+    def _log(self, message, *args):
+        if self.verbose:
+            print('[server {:.3f}] {}'.format(time.monotonic(), message.format(*args)))
+
+
+async def serve(host='0.0.0.0', port=1700, **kwargs):
+    """
+    Starts a server on the running event loop, returns (transport, server).
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(lambda: SemtechServer(**kwargs), local_addr=(host, port))
+
+
+async def _main(args):
+    transport, server = await serve(args.host, args.port, drop_acks=args.drop_acks,
+                                    ack_delay_ms=args.ack_delay, verbose=True)
+    print('Listening on {}:{}'.format(args.host, args.port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Semtech UDP network server stand-in')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=1700)
+    parser.add_argument('--drop-acks', type=float, default=0.0, help='probability of not acknowledging')
+    parser.add_argument('--ack-delay', type=int, default=0, help='acknowledgement delay in ms')
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
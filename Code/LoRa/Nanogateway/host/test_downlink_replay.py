@@ -0,0 +1,28 @@
+""" Checks the class A downlink scheduler against the built-in replay scenario.
+
+Run with `python3 -m pytest host/test_downlink_replay.py`.
+"""
+
+from downlink_replay import SCENARIO
+from downlink_replay import replay
+
+
+def test_scenario_acks():
+    result = replay(SCENARIO.splitlines())
+    assert all(expected is not None for *_, expected in result.acks)
+    assert result.mismatches() == []
+
+
+def test_scenario_transmissions():
+    result = replay(SCENARIO.splitlines())
+    lead_us = result.scheduler.lead_us
+    # every accepted downlink goes to the radio once, lead_us before its tmst
+    accepted = sorted(a[1] for a in result.acks if a[5] == 'NONE')
+    assert [tmst for at, tmst in result.sent] == accepted
+    assert all(tmst - at == lead_us for at, tmst in result.sent)
+
+
+def test_regression_is_reported():
+    lines = ['1000000 2000000 SF7BW125 12 NONE', '1100000 2000000 SF7BW125 12 NONE']
+    result = replay(lines)
+    assert [a[5] for a in result.mismatches()] == ['COLLISION_PACKET']
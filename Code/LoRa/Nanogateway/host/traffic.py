@@ -0,0 +1,132 @@
+""" Uplink arrival patterns for driving the emulated nano gateway radio.
+
+Every pattern returns a time ordered list of Frame, the offset in seconds
+from the start of the run at which the frame ends on the air. Frames are
+LoRaWAN unconfirmed data uplinks with a DevAddr and FCnt per node, so every
+transmission is unique unless it is a deliberate retransmission.
+"""
+
+import random
+
+# share of the end devices per SF at a typical site using ADR
+SF_MIX = ((7, 0.45), (8, 0.15), (9, 0.15), (10, 0.1), (11, 0.05), (12, 0.1))
+
+
+class Frame:
+
+    def __init__(self, at, data, sf, rssi, snr, node=None):
+        self.at = at
+        self.data = data
+        self.sf = sf
+        self.rssi = rssi
+        self.snr = snr
+        self.node = node
+
+
+class Node:
+    """
+    An end device with its own DevAddr, frame counter, SF and link budget.
+    """
+
+    def __init__(self, rnd, devaddr, sf, size):
+        self.rnd = rnd
+        self.devaddr = devaddr
+        self.sf = sf
+        self.size = size
+        self.fcnt = rnd.randrange(1000)
+        self.rssi = rnd.randint(-125, -50)
+        self.snr = round(rnd.uniform(-18, 10), 1)
+
+    def frame(self, at):
+        self.fcnt = (self.fcnt + 1) & 0xFFFF
+        body = bytes(self.rnd.randrange(256) for i in range(max(0, self.size - 12)))
+        data = b'\x40' + self.devaddr.to_bytes(4, 'little') + b'\x00' + self.fcnt.to_bytes(2, 'little') + body + bytes(4)
+        # a few dB of fading between frames
+        return Frame(at, data, self.sf, self.rssi + self.rnd.randint(-3, 3), self.snr, self)
+
+
+def pick_sf(rnd, mix=SF_MIX):
+    x = rnd.random()
+    for sf, share in mix:
+        x -= share
+        if x <= 0:
+            return sf
+    return mix[-1][0]
+
+
+def make_nodes(count, rnd, sfs=None, size=20):
+    """
+    Returns count nodes with TTN DevAddrs, with SFs picked from sfs or the
+    ADR mix.
+    """
+
+    return [Node(rnd, 0x26000000 | rnd.randrange(1 << 25), rnd.choice(sfs) if sfs else pick_sf(rnd), size)
+            for i in range(count)]
+
+
+def poisson(rate, duration, nodes, rnd):
+    """
+    Frames from random nodes with exponential inter-arrival times.
+    """
+
+    frames = []
+    at = rnd.expovariate(rate)
+    while at < duration:
+        frames.append(rnd.choice(nodes).frame(at))
+        at += rnd.expovariate(rate)
+    return frames
+
+
+def periodic(period, duration, nodes, rnd, jitter=0.1, retransmit=0.0, retransmit_delay=2.0):
+    """
+    Every node sends every period seconds with a random phase and some
+    jitter, like metering devices do. With probability retransmit a frame
+    is sent once more unchanged retransmit_delay seconds later, like an
+    unconfirmed uplink with NbTrans 2.
+    """
+
+    frames = []
+    for node in nodes:
+        at = rnd.uniform(0, period)
+        while at < duration:
+            frame = node.frame(at)
+            frames.append(frame)
+            if retransmit and rnd.random() < retransmit and at + retransmit_delay < duration:
+                frames.append(Frame(at + retransmit_delay, frame.data, frame.sf, frame.rssi, frame.snr, node))
+            at += period * rnd.uniform(1 - jitter, 1 + jitter)
+    frames.sort(key=lambda f: f.at)
+    return frames
+
+
+def bursts(every, size, spread, duration, nodes, rnd):
+    """
+    Bursts of size frames within spread seconds every every seconds, like
+    devices woken up together by a power cut or a multicast.
+    """
+
+    frames = []
+    start = every / 2
+    while start < duration:
+        for k in range(size):
+            frames.append(rnd.choice(nodes).frame(start + rnd.uniform(0, spread)))
+        start += every
+    frames.sort(key=lambda f: f.at)
+    return frames
+
+
+PATTERNS = {
+    'poisson': lambda args, nodes, rnd: poisson(args.rate, args.duration, nodes, rnd),
+    'periodic': lambda args, nodes, rnd: periodic(len(nodes) / args.rate, args.duration, nodes, rnd, retransmit=args.retransmit),
+    'bursts': lambda args, nodes, rnd: bursts(args.burst_every, args.burst_size, args.burst_spread, args.duration, nodes, rnd),
+}
+
+
+def generate(pattern, args, seed=1):
+    """
+    Builds the frames of a pattern from the benchmark arguments.
+    """
+
+    rnd = random.Random(seed)
+    sfs = [int(sf) for sf in args.sf.split(',')] if args.sf else None
+    nodes = make_nodes(args.nodes, rnd, sfs, args.size)
+    return PATTERNS[pattern](args, nodes, rnd)
@@ -0,0 +1,71 @@
+""" Interrupt context emulation shared by the machine and network stand-ins.
+
+On the LoPy the Timer.Alarm handlers and the LoRa radio callbacks all run
+one after the other in the same callback thread. A single dispatcher thread
+running a time ordered queue reproduces that, so handlers never run
+concurrently with each other, only with the gateway threads.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+_queue = []
+_seq = itertools.count()
+_cond = threading.Condition()
+_thread = None
+
+# exceptions raised by handlers, they are printed and kept for inspection
+errors = []
+
+
+def call_at(due, fn, *args):
+    """
+    Runs fn(*args) in the dispatcher thread at the monotonic time due.
+    Returns an entry that can be passed to cancel().
+    """
+
+    entry = [due, next(_seq), fn, args, True]
+    with _cond:
+        _start()
+        heapq.heappush(_queue, entry)
+        _cond.notify()
+    return entry
+
+
+def call_later(delay_s, fn, *args):
+    return call_at(time.monotonic() + delay_s, fn, *args)
+
+
+def cancel(entry):
+    # entries are dropped lazily when they come up
+    entry[4] = False
+
+
+def _start():
+    global _thread
+    if _thread is None:
+        _thread = threading.Thread(target=_run, name='irq', daemon=True)
+        _thread.start()
+
+
+def _run():
+    while True:
+        with _cond:
+            while True:
+                if _queue:
+                    wait = _queue[0][0] - time.monotonic()
+                    if wait <= 0:
+                        entry = heapq.heappop(_queue)
+                        break
+                    _cond.wait(wait)
+                else:
+                    _cond.wait()
+        if not entry[4]:
+            continue
+        try:
+            entry[2](*entry[3])
+        except Exception as ex:
+            errors.append(ex)
+            print('Unhandled exception in callback handler: {!r}'.format(ex))
@@ -0,0 +1,83 @@
+""" machine stand-in for running the nano gateway under CPython. """
+
+import sys
+import time
+
+import hostirq
+
+_UNIQUE_ID = b'\x24\x0a\xc4\x00\x01\x02'
+
+
+def unique_id():
+    return _UNIQUE_ID
+
+
+def reset():
+    sys.exit('machine.reset()')
+
+
+def idle():
+    time.sleep(0.001)
+
+
+class RTC:
+    """
+    Real time clock taken from the host clock, synced as soon as asked.
+    """
+
+    def __init__(self, id=0):
+        self.ntp_server = None
+        self._synced = False
+
+    def ntp_sync(self, server, update_period=3600):
+        self.ntp_server = server
+        self._synced = server is not None
+
+    def synced(self):
+        return self._synced
+
+    def now(self):
+        t = time.time()
+        tm = time.gmtime(t)
+        return (tm[0], tm[1], tm[2], tm[3], tm[4], tm[5], int((t % 1) * 1000000), None)
+
+    def init(self, datetime=None):
+        pass
+
+
+class Timer:
+
+    class Alarm:
+        """
+        One shot or periodic alarm, the handler runs in the emulated
+        interrupt context with the alarm as its argument.
+        """
+
+        def __init__(self, handler, s=None, ms=None, us=None, arg=None, periodic=False):
+            self.handler = handler
+            self.arg = arg
+            self.periodic = periodic
+            self.period = (s or 0) + (ms or 0) / 1000 + (us or 0) / 1000000
+            self.entry = None
+            self._arm(time.monotonic() + self.period)
+
+        def cancel(self):
+            self.periodic = False
+            if self.entry is not None:
+                hostirq.cancel(self.entry)
+                self.entry = None
+
+        def callback(self, handler, arg=None):
+            self.handler = handler
+            self.arg = arg
+
+        def _arm(self, due):
+            self.entry = hostirq.call_at(due, self._fire, due)
+
+        def _fire(self, due):
+            if self.periodic:
+                self._arm(due + self.period)
+            else:
+                self.entry = None
+            if self.handler:
+                self.handler(self if self.arg is None else self.arg)
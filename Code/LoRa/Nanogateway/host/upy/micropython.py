@@ -0,0 +1,5 @@
+""" micropython stand-in for running the nano gateway under CPython. """
+
+
+def const(value):
+    return value
@@ -0,0 +1,217 @@
+""" network stand-in for running the nano gateway under CPython.
+
+LoRa emulates the LoPy radio in raw LoRa mode. Frames are put on the air
+with inject(), they are received only if the radio listens on their
+frequency and SF for their whole time on air, is not transmitting and is
+not still receiving the previous frame, otherwise they are counted in
+missed. Transmissions take their time on air
+and are recorded in transmitted.
+
+WLAN is always connected unless WLAN.available is cleared, which also makes
+the usocket stand-in fail to send, to reproduce a backhaul outage.
+"""
+
+import collections
+import time
+
+import hostirq
+import utime
+from airtime import airtime_us
+
+RadioStats = collections.namedtuple('RadioStats', (
+    'rx_timestamp', 'rssi', 'snr', 'sftx', 'sfrx', 'tx_trials',
+    'tx_power', 'tx_time_on_air', 'tx_counter', 'tx_frequency'))
+
+_BW_KHZ = (125, 250, 500)
+
+# the radio the usocket stand-in sends and receives with
+radio = None
+
+
+class LoRa:
+
+    LORA = 0
+    LORAWAN = 1
+
+    BW_125KHZ = 0
+    BW_250KHZ = 1
+    BW_500KHZ = 2
+
+    CODING_4_5 = 1
+    CODING_4_6 = 2
+    CODING_4_7 = 3
+    CODING_4_8 = 4
+
+    CLASS_A = 0
+    CLASS_C = 2
+
+    RX_PACKET_EVENT = 1
+    TX_PACKET_EVENT = 2
+    TX_FAILED_EVENT = 4
+
+    ALWAYS_ON = 0
+    TX_ONLY = 1
+    SLEEP = 2
+
+    EU868 = 5
+    US915 = 8
+
+    def __init__(self, mode=LORA, **kwargs):
+        global radio
+        self._frequency = 868000000
+        self._bandwidth = LoRa.BW_125KHZ
+        self._sf = 7
+        self.preamble = 8
+        self.tx_iq = False
+        self.device_class = LoRa.CLASS_A
+        self.power = LoRa.ALWAYS_ON
+        self.tuned_at = time.monotonic()
+
+        self.trigger = 0
+        self.handler = None
+        self._events = 0
+        self._stats = RadioStats(0, 0, 0.0, 7, 7, 0, 14, 0, 0, 0)
+        self.rx_fifo = collections.deque()
+        self.tx_until = 0
+        self.rx_until = 0
+
+        self.received = 0
+        self.missed = 0
+        self.inits = 0
+        self.transmitted = []
+        # set to a list to keep the payloads of the received frames
+        self.rx_log = None
+
+        self.init(mode, **kwargs)
+        radio = self
+
+    def init(self, mode=LORA, frequency=None, bandwidth=None, sf=None, preamble=8, coding_rate=CODING_4_5,
+             tx_iq=False, rx_iq=False, device_class=CLASS_A, **kwargs):
+        if frequency is not None:
+            self._frequency = frequency
+        if bandwidth is not None:
+            self._bandwidth = bandwidth
+        if sf is not None:
+            self._sf = sf
+        self.preamble = preamble
+        self.tx_iq = tx_iq
+        self.device_class = device_class
+        self.power = LoRa.ALWAYS_ON
+        self.tuned_at = time.monotonic()
+        self.inits += 1
+
+    def frequency(self, frequency=None):
+        if frequency is None:
+            return self._frequency
+        self._frequency = frequency
+        self.tuned_at = time.monotonic()
+
+    def bandwidth(self, bandwidth=None):
+        if bandwidth is None:
+            return self._bandwidth
+        self._bandwidth = bandwidth
+        self.tuned_at = time.monotonic()
+
+    def sf(self, sf=None):
+        if sf is None:
+            return self._sf
+        self._sf = sf
+        self.tuned_at = time.monotonic()
+
+    def power_mode(self, mode=None):
+        if mode is None:
+            return self.power
+        self.power = mode
+
+    def callback(self, trigger, handler=None, arg=None):
+        self.trigger = trigger or 0
+        self.handler = handler
+
+    def events(self):
+        events = self._events
+        self._events = 0
+        return events
+
+    def stats(self):
+        return self._stats
+
+    def ischannel_free(self, rssi_threshold):
+        return time.monotonic() >= self.tx_until
+
+    def inject(self, data, frequency=None, sf=None, rssi=-60, snr=7.0, tmst=None):
+        """
+        Puts a frame on the air that ends now. frequency and sf default to
+        the ones the radio listens on. The radio timestamps the frame with
+        ticks_cpu unless tmst is given, to reproduce timestamps seen in the
+        field; utime.set_ticks_cpu moves the whole clock instead.
+        """
+
+        data = bytes(data)
+        hostirq.call_later(0, self._rx, data, frequency, sf, rssi, snr, time.monotonic(), tmst)
+
+    def _rx(self, data, frequency, sf, rssi, snr, end, tmst=None):
+        sf = self._sf if sf is None else sf
+        frequency = self._frequency if frequency is None else frequency
+        airtime = airtime_us(sf, _BW_KHZ[self._bandwidth], len(data), self.preamble, crc=True) / 1000000
+        if (self.power == LoRa.SLEEP or frequency != self._frequency or sf != self._sf or
+                self.tuned_at > end - airtime or self.tx_until > end - airtime or self.rx_until > end - airtime):
+            self.missed += 1
+            return
+        self.rx_until = end
+        self.received += 1
+        if self.rx_log is not None:
+            self.rx_log.append(data)
+        self.rx_fifo.append(data)
+        if tmst is None:
+            tmst = utime.ticks_cpu()
+        self._stats = self._stats._replace(rx_timestamp=tmst & 0xFFFFFFFF, rssi=rssi, snr=snr, sfrx=sf)
+        self._event(LoRa.RX_PACKET_EVENT)
+
+    def _tx(self, data):
+        airtime = airtime_us(self._sf, _BW_KHZ[self._bandwidth], len(data), self.preamble) / 1000000
+        self.tx_until = time.monotonic() + airtime
+        self.transmitted.append((utime.ticks_cpu(), self._frequency, self._sf, bytes(data)))
+        self._stats = self._stats._replace(sftx=self._sf, tx_time_on_air=int(airtime * 1000),
+                                           tx_counter=self._stats.tx_counter + 1, tx_frequency=self._frequency)
+        hostirq.call_later(airtime, self._event, LoRa.TX_PACKET_EVENT)
+
+    def _event(self, event):
+        self._events |= event
+        if self.handler and self.trigger & event:
+            self.handler(self)
+
+
+class WLAN:
+
+    STA = 1
+    AP = 2
+    STA_AP = 3
+
+    WPA2 = 3
+
+    # clear to emulate the access point going away
+    available = True
+
+    def __init__(self, mode=STA, **kwargs):
+        self.mode = mode
+        self.connected = False
+        self.ssid = None
+
+    def connect(self, ssid, auth=None, timeout=None, **kwargs):
+        self.ssid = ssid
+        self.connected = True
+
+    def isconnected(self):
+        return self.connected and WLAN.available
+
+    def disconnect(self):
+        self.connected = False
+
+    def deinit(self):
+        self.connected = False
+
+    def ifconfig(self, config=None):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+    def mac(self):
+        return b'\x24\x0a\xc4\x00\x01\x02'
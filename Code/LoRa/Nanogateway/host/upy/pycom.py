@@ -0,0 +1,18 @@
+""" pycom stand-in for running the nano gateway under CPython. """
+
+_rgb = 0
+_heartbeat = True
+
+
+def heartbeat(state=None):
+    global _heartbeat
+    if state is None:
+        return _heartbeat
+    _heartbeat = state
+
+
+def rgbled(color=None):
+    global _rgb
+    if color is None:
+        return _rgb
+    _rgb = color
@@ -0,0 +1,3 @@
+""" ubinascii stand-in for running the nano gateway under CPython. """
+
+from binascii import *  # noqa: F401, F403
@@ -0,0 +1,3 @@
+""" ujson stand-in for running the nano gateway under CPython. """
+
+from json import dumps, dump, loads, load  # noqa: F401
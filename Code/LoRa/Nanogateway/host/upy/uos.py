@@ -0,0 +1,3 @@
+""" uos stand-in for running the nano gateway under CPython. """
+
+from os import listdir, mkdir, remove, rename, rmdir, stat, urandom  # noqa: F401
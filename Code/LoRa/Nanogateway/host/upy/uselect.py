@@ -0,0 +1,37 @@
+""" uselect stand-in for running the nano gateway under CPython.
+
+MicroPython's poll() returns the registered objects, not file numbers.
+"""
+
+import select as _select
+
+POLLIN = _select.POLLIN
+POLLOUT = _select.POLLOUT
+POLLERR = _select.POLLERR
+POLLHUP = _select.POLLHUP
+
+
+def poll():
+    return Poll()
+
+
+class Poll:
+
+    def __init__(self):
+        self.poller = _select.poll()
+        self.objects = {}
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        self.objects[obj.fileno()] = obj
+        self.poller.register(obj.fileno(), eventmask)
+
+    def unregister(self, obj):
+        fd = obj.fileno()
+        self.objects.pop(fd, None)
+        self.poller.unregister(fd)
+
+    def modify(self, obj, eventmask):
+        self.poller.modify(obj.fileno(), eventmask)
+
+    def poll(self, timeout=-1):
+        return [(self.objects[fd], event) for fd, event in self.poller.poll(timeout) if fd in self.objects]
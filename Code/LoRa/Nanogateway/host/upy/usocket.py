@@ -0,0 +1,85 @@
+""" usocket stand-in for running the nano gateway under CPython.
+
+IP sockets are host sockets that also accept str payloads like MicroPython
+does, and fail to send while network.WLAN.available is cleared. AF_LORA
+raw sockets send and receive through the emulated radio.
+"""
+
+import errno
+import socket as _socket
+
+import network
+
+AF_INET = _socket.AF_INET
+SOCK_DGRAM = _socket.SOCK_DGRAM
+SOCK_STREAM = _socket.SOCK_STREAM
+IPPROTO_UDP = _socket.IPPROTO_UDP
+SOL_SOCKET = _socket.SOL_SOCKET
+SO_REUSEADDR = _socket.SO_REUSEADDR
+
+AF_LORA = 160
+SOCK_RAW = 3
+
+timeout = _socket.timeout
+error = OSError
+
+
+def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    return _socket.getaddrinfo(host, port, AF_INET, SOCK_DGRAM)
+
+
+def socket(family=AF_INET, type=SOCK_STREAM, proto=0):
+    if family == AF_LORA:
+        return LoRaSocket()
+    return Socket(_socket.socket(family, type, proto))
+
+
+class Socket:
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def sendto(self, data, address):
+        if not network.WLAN.available:
+            raise OSError(errno.ENETUNREACH, 'network unreachable')
+        if isinstance(data, str):
+            data = data.encode()
+        return self.sock.sendto(data, address)
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        return self.sock.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class LoRaSocket:
+
+    def __init__(self):
+        self.blocking = True
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def settimeout(self, value):
+        pass
+
+    def recv(self, size):
+        fifo = network.radio.rx_fifo
+        if not fifo:
+            if not self.blocking:
+                raise OSError(errno.EAGAIN, 'no frame')
+            return b''
+        return fifo.popleft()[:size]
+
+    def send(self, data):
+        network.radio._tx(data)
+        return len(data)
+
+    def close(self):
+        pass
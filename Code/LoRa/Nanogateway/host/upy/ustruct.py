@@ -0,0 +1,3 @@
+""" ustruct stand-in for running the nano gateway under CPython. """
+
+from struct import calcsize, pack, pack_into, unpack, unpack_from  # noqa: F401
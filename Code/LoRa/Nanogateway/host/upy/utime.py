@@ -0,0 +1,77 @@
+""" utime stand-in for running the nano gateway under CPython. """
+
+import calendar
+import time as _time
+
+# MicroPython tick counters wrap around, like on the LoPy: ticks_ms and
+# ticks_us at 2**30, ticks_cpu (the radio timestamp clock) at 2**32
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALF = TICKS_PERIOD // 2
+
+_start = _time.monotonic()
+# added to ticks_cpu, see set_ticks_cpu
+_cpu_offset = 0
+
+
+def _elapsed_us():
+    return int((_time.monotonic() - _start) * 1000000)
+
+
+def ticks_ms():
+    return (_elapsed_us() // 1000) & TICKS_MAX
+
+
+def ticks_us():
+    return _elapsed_us() & TICKS_MAX
+
+
+def ticks_cpu():
+    return (_elapsed_us() + _cpu_offset) & 0xFFFFFFFF
+
+
+def set_ticks_cpu(ticks):
+    """
+    Not in MicroPython: makes ticks_cpu, the tmst clock of the radio, read
+    ticks now, e.g. just below 2**32 to reproduce a tmst wraparound.
+    """
+
+    global _cpu_offset
+    _cpu_offset = (ticks - _elapsed_us()) & 0xFFFFFFFF
+
+
+def ticks_diff(end, start):
+    return ((end - start + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def sleep(s):
+    _time.sleep(s)
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+
+def time():
+    return int(_time.time())
+
+
+def localtime(secs=None):
+    return _time.gmtime(secs)[:8]
+
+
+def gmtime(secs=None):
+    return _time.gmtime(secs)[:8]
+
+
+def mktime(t):
+    # the gateway RTC runs in UTC, like localtime above
+    return calendar.timegm(tuple(t[:6]) + (0, 0, 0))
@@ -0,0 +1,61 @@
+""" Adaptive PULL_DATA keepalive and stat intervals for the LoPy nano gateway. """
+
+GROW_PERCENT = 150
+PROBE_SUCCESSES = 10
+
+
+class AdaptiveInterval:
+    """
+    An interval between min_ms and max_ms. Activity brings it down to the
+    minimum, each idle period makes it grow by GROW_PERCENT.
+
+    For the PULL_DATA keepalive a missing PULL_ACK means the path to the
+    server is lossy or the firewall drops idle flows early: the interval
+    drops to the minimum and a ceiling is set below the interval that
+    failed. After PROBE_SUCCESSES acknowledged keepalives at the ceiling it
+    is raised again, in case the failure was a transient one.
+    """
+
+    def __init__(self, min_ms, max_ms, initial_ms=None):
+        self.min_ms = min_ms
+        self.max_ms = max(min_ms, max_ms)
+        self.ceiling_ms = self.max_ms
+        self.interval_ms = initial_ms if initial_ms is not None else min_ms
+        self.interval_ms = min(max(self.interval_ms, self.min_ms), self.max_ms)
+        self.successes = 0
+
+        self.busy_count = 0
+        self.failures = 0
+
+    def busy(self):
+        """
+        Traffic since the last interval, come back soon.
+        """
+
+        self.busy_count += 1
+        self.interval_ms = self.min_ms
+        return self.interval_ms
+
+    def idle(self):
+        """
+        Nothing happened, wait longer next time, up to the ceiling.
+        """
+
+        if self.interval_ms >= self.ceiling_ms and self.ceiling_ms < self.max_ms:
+            self.successes += 1
+            if self.successes >= PROBE_SUCCESSES:
+                self.successes = 0
+                self.ceiling_ms = min(self.max_ms, self.ceiling_ms * GROW_PERCENT // 100)
+        self.interval_ms = min(self.ceiling_ms, self.interval_ms * GROW_PERCENT // 100)
+        return self.interval_ms
+
+    def failed(self):
+        """
+        The keepalive was not answered, keep the binding alive more often.
+        """
+
+        self.failures += 1
+        self.successes = 0
+        self.ceiling_ms = max(self.min_ms, self.interval_ms * 3 // 4)
+        self.interval_ms = self.min_ms
+        return self.interval_ms
@@ -0,0 +1,170 @@
+""" Leveled, ring buffered logging for the LoPy nano gateway. """
+
+import uos
+import _thread
+import utime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'D', INFO: 'I', WARNING: 'W', ERROR: 'E'}
+
+LOG_SLOTS = 64
+LOG_FLUSH_MS = 200
+LOG_FILE_BYTES = 32768
+
+
+class Logger:
+    """
+    Keeps log records in a fixed-size ring, unformatted: a record is only
+    the message, its arguments and a timestamp. Records below the level are
+    dropped before anything else is done, the others are formatted when
+    they are written out, by the flusher thread once it is started or right
+    away before that. When the ring is full the oldest record is dropped.
+
+    The arguments are formatted later, so mutable objects should be passed
+    as a copy.
+    """
+
+    def __init__(self, level=INFO, slots=LOG_SLOTS):
+        self.level = level
+        self.ms = [0] * slots
+        self.levels = [0] * slots
+        self.messages = [None] * slots
+        self.args = [None] * slots
+        self.wr = 0
+        self.rd = 0
+        self.lock = _thread.allocate_lock()
+
+        self.path = None
+        self.max_bytes = LOG_FILE_BYTES
+        self.flush_ms = LOG_FLUSH_MS
+        self.running = False
+        self.stopping = False
+
+        self.emitted = 0
+        self.dropped = 0
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self._put(DEBUG, message, args)
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            self._put(INFO, message, args)
+
+    def warning(self, message, *args):
+        if WARNING >= self.level:
+            self._put(WARNING, message, args)
+
+    def error(self, message, *args):
+        if ERROR >= self.level:
+            self._put(ERROR, message, args)
+
+    def start(self, path=None, flush_ms=LOG_FLUSH_MS, max_bytes=LOG_FILE_BYTES):
+        """
+        Starts the flusher thread, writing to the UART (stdout) or, when a
+        path is given, to a file on flash that is rotated to path.1 once it
+        reaches max_bytes.
+        """
+
+        self.path = path
+        self.flush_ms = flush_ms
+        self.max_bytes = max_bytes
+        self.running = True
+        _thread.start_new_thread(self._flusher_thread, ())
+
+    def stop(self):
+        """
+        Stops the flusher thread after it wrote out the pending records.
+        """
+
+        if not self.running:
+            return
+        self.stopping = True
+        while self.stopping:
+            utime.sleep_ms(50)
+
+    def flush(self):
+        """
+        Formats and writes out all the pending records.
+        """
+
+        f = None
+        try:
+            while True:
+                line = self._pop()
+                if line is None:
+                    break
+                if self.path is None:
+                    print(line)
+                    continue
+                if f is None:
+                    f = self._open()
+                f.write(line)
+                f.write('\n')
+        finally:
+            if f is not None:
+                f.close()
+
+    def __len__(self):
+        return self.wr - self.rd
+
+    def _put(self, level, message, args):
+        slots = len(self.messages)
+        with self.lock:
+            if self.wr - self.rd >= slots:
+                self.rd += 1
+                self.dropped += 1
+            i = self.wr % slots
+            self.ms[i] = utime.ticks_ms()
+            self.levels[i] = level
+            self.messages[i] = message
+            self.args[i] = args
+            self.wr += 1
+        if not self.running:
+            self.flush()
+
+    def _pop(self):
+        # takes the oldest record out under the lock, formats it outside
+        with self.lock:
+            if self.rd == self.wr:
+                return None
+            i = self.rd % len(self.messages)
+            ms = self.ms[i]
+            level = self.levels[i]
+            message = self.messages[i]
+            args = self.args[i]
+            self.messages[i] = None
+            self.args[i] = None
+            self.rd += 1
+        self.emitted += 1
+        try:
+            text = str(message).format(*args) if args else str(message)
+        except Exception as ex:
+            text = '{} {!r}: {}'.format(message, args, ex)
+        return '[{:>10.3f}] {} {}'.format(ms / 1000, LEVEL_NAMES.get(level, '?'), text)
+
+    def _open(self):
+        try:
+            if uos.stat(self.path)[6] >= self.max_bytes:
+                try:
+                    uos.remove(self.path + '.1')
+                except OSError:
+                    pass
+                uos.rename(self.path, self.path + '.1')
+        except OSError:
+            pass
+        return open(self.path, 'a')
+
+    def _flusher_thread(self):
+        while not self.stopping:
+            utime.sleep_ms(self.flush_ms)
+            try:
+                self.flush()
+            except Exception as ex:
+                print('Log flush Exception: {}'.format(ex))
+        self.flush()
+        self.running = False
+        self.stopping = False
@@ -0,0 +1,166 @@
+""" LoRaWAN frame header parsing and uplink filtering for the LoPy nano gateway. """
+
+import ubinascii
+
+MTYPE_JOIN_REQUEST = 0
+MTYPE_UNCONFIRMED_UP = 2
+MTYPE_CONFIRMED_UP = 4
+
+# MHDR + DevAddr + FCtrl + FCnt + MIC, and the size of a join request
+DATA_MIN_LEN = 12
+JOIN_REQUEST_LEN = 23
+
+# why a frame was dropped, indexes of FrameFilter.drops
+DROP_MALFORMED = 0
+DROP_DEVADDR_DENY = 1
+DROP_DEVADDR_ALLOW = 2
+DROP_JOINEUI_DENY = 3
+DROP_JOINEUI_ALLOW = 4
+DROP_NAMES = ('malformed', 'devaddr_deny', 'devaddr_allow', 'joineui_deny', 'joineui_allow')
+
+# length of the type prefix and of the NwkID of a DevAddr per NetID type
+_NETID_PREFIX_BITS = (1, 2, 3, 4, 5, 6, 7, 8)
+_NETID_NWKID_BITS = (6, 6, 9, 11, 12, 13, 15, 17)
+
+
+def netid_prefix(netid):
+    """
+    Returns the (devaddr, bits) prefix of the device addresses of a NetID,
+    e.g. (0x26000000, 7) for the NetID 0x000013 of The Things Network.
+    """
+
+    nettype = netid >> 21
+    nwkid_bits = _NETID_NWKID_BITS[nettype]
+    prefix_bits = _NETID_PREFIX_BITS[nettype]
+    # the type prefix is nettype ones followed by a zero
+    addr = ((0xFF << (8 - nettype)) & 0xFF) << 24
+    addr |= (netid & ((1 << nwkid_bits) - 1)) << (32 - prefix_bits - nwkid_bits)
+    return (addr & 0xFFFFFFFF, prefix_bits + nwkid_bits)
+
+
+def parse_devaddr_prefix(text):
+    """
+    Parses a DevAddr prefix given as 'AABBCCDD/bits', or as 'netid:NNNNNN'
+    for all the addresses of a NetID. Returns (devaddr, bits).
+    """
+
+    if text.startswith('netid:'):
+        return netid_prefix(int(text[6:], 16))
+    if '/' in text:
+        addr, bits = text.split('/')
+        return (int(addr, 16), int(bits))
+    return (int(text, 16), 32)
+
+
+class DevAddrPrefix:
+    """
+    A DevAddr prefix, matched in two 16 bit halves so that no long integer
+    is created per frame.
+    """
+
+    def __init__(self, addr, bits, text=None):
+        self.text = text
+        mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF if bits else 0
+        self.hi = (addr >> 16) & (mask >> 16)
+        self.lo = addr & mask & 0xFFFF
+        self.mask_hi = mask >> 16
+        self.mask_lo = mask & 0xFFFF
+        self.hits = 0
+
+    def match(self, data):
+        # the DevAddr is little endian in bytes 1..4 of the frame
+        return ((data[4] << 8 | data[3]) & self.mask_hi) == self.hi and \
+               ((data[2] << 8 | data[1]) & self.mask_lo) == self.lo
+
+
+class JoinEuiPrefix:
+    """
+    A JoinEUI (AppEUI) prefix of whole bytes, given in hex as it is usually
+    written, most significant byte first.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.eui = ubinascii.unhexlify(text)
+        self.hits = 0
+
+    def match(self, data):
+        # the JoinEUI is little endian in bytes 1..8 of a join request
+        eui = self.eui
+        for k in range(len(eui)):
+            if data[8 - k] != eui[k]:
+                return False
+        return True
+
+
+class FrameFilter:
+    """
+    Decides from the MHDR and FHDR whether a received frame is forwarded.
+    Data uplinks are matched by DevAddr prefix and join requests by JoinEUI.
+    A deny list drops the frames it matches, a non empty allow list drops
+    the frames it does not match. Other message types and LoRaWAN major
+    versions are always forwarded.
+    """
+
+    def __init__(self, devaddr_allow=(), devaddr_deny=(), joineui_allow=(), joineui_deny=()):
+        self.devaddr_allow = [DevAddrPrefix(*parse_devaddr_prefix(p), text=p) for p in devaddr_allow]
+        self.devaddr_deny = [DevAddrPrefix(*parse_devaddr_prefix(p), text=p) for p in devaddr_deny]
+        self.joineui_allow = [JoinEuiPrefix(p) for p in joineui_allow]
+        self.joineui_deny = [JoinEuiPrefix(p) for p in joineui_deny]
+
+        self.passed = 0
+        self.drops = [0] * len(DROP_NAMES)
+
+    def accept(self, data):
+        """
+        Returns whether the frame is to be forwarded, counting the drops.
+        """
+
+        reason = self._check(data)
+        if reason < 0:
+            self.passed += 1
+            return True
+        self.drops[reason] += 1
+        return False
+
+    def dropped(self):
+        return sum(self.drops)
+
+    def rule_hits(self):
+        """
+        Returns (list name, rule, hits) for every rule, in configuration order.
+        """
+
+        hits = []
+        for name, rules in (('devaddr_allow', self.devaddr_allow), ('devaddr_deny', self.devaddr_deny),
+                            ('joineui_allow', self.joineui_allow), ('joineui_deny', self.joineui_deny)):
+            for rule in rules:
+                hits.append((name, rule.text, rule.hits))
+        return hits
+
+    def _check(self, data):
+        if not data or data[0] & 0x03:
+            return -1
+        mtype = data[0] >> 5
+        if mtype == MTYPE_UNCONFIRMED_UP or mtype == MTYPE_CONFIRMED_UP:
+            if len(data) < DATA_MIN_LEN:
+                return DROP_MALFORMED
+            return self._match(data, self.devaddr_deny, self.devaddr_allow, DROP_DEVADDR_DENY, DROP_DEVADDR_ALLOW)
+        if mtype == MTYPE_JOIN_REQUEST:
+            if len(data) != JOIN_REQUEST_LEN:
+                return DROP_MALFORMED
+            return self._match(data, self.joineui_deny, self.joineui_allow, DROP_JOINEUI_DENY, DROP_JOINEUI_ALLOW)
+        return -1
+
+    def _match(self, data, deny, allow, deny_reason, allow_reason):
+        for prefix in deny:
+            if prefix.match(data):
+                prefix.hits += 1
+                return deny_reason
+        if not allow:
+            return -1
+        for prefix in allow:
+            if prefix.match(data):
+                prefix.hits += 1
+                return -1
+        return allow_reason
@@ -13,9 +13,42 @@ if __name__ == '__main__':
         server=config.SERVER,
         port=config.PORT,
         ntp_server=config.NTP,
-        ntp_period=config.NTP_PERIOD_S
+        ntp_period=config.NTP_PERIOD_S,
+        push_window_ms=config.PUSH_WINDOW_MS,
+        push_batch_max=config.PUSH_BATCH_MAX,
+        rx_ring_slots=config.RX_RING_SLOTS,
+        tx_calibrate=config.TX_CALIBRATE,
+        push_ack_timeout_ms=config.PUSH_ACK_TIMEOUT_MS,
+        push_retransmit=config.PUSH_RETRANSMIT,
+        spool_path=config.SPOOL_PATH,
+        spool_bytes=config.SPOOL_BYTES,
+        spool_rate_ms=config.SPOOL_RATE_MS,
+        pull_ack_timeout_s=config.PULL_ACK_TIMEOUT_S,
+        dns_period_s=config.DNS_PERIOD_S,
+        servers=config.SERVERS,
+        server_mode=config.SERVER_MODE,
+        devaddr_allow=config.FILTER_DEVADDR_ALLOW,
+        devaddr_deny=config.FILTER_DEVADDR_DENY,
+        joineui_allow=config.FILTER_JOINEUI_ALLOW,
+        joineui_deny=config.FILTER_JOINEUI_DENY,
+        dedup_window_ms=config.DEDUP_WINDOW_MS,
+        stat_extended=config.STAT_EXTENDED,
+        duty_cycle=config.DUTY_CYCLE,
+        rx_scan=config.RX_SCAN,
+        rx_scan_cycle_ms=config.RX_SCAN_CYCLE_MS,
+        log_level=config.LOG_LEVEL,
+        log_path=config.LOG_PATH,
+        query_port=config.QUERY_PORT,
+        pull_min_s=config.PULL_MIN_S,
+        pull_max_s=config.PULL_MAX_S,
+        stat_min_s=config.STAT_MIN_S,
+        stat_max_s=config.STAT_MAX_S,
+        class_c_queue_size=config.CLASS_C_QUEUE_SIZE,
+        class_c_tx_percent=config.CLASS_C_TX_PERCENT,
+        capture_path=config.CAPTURE_PATH,
+        capture_bytes=config.CAPTURE_BYTES
         )
 
     nanogw.start()
-    nanogw._log('You may now press ENTER to enter the REPL')
+    nanogw.log.info('You may now press ENTER to enter the REPL')
     input()
@@ -0,0 +1,85 @@
+""" Performance counters for the LoPy nano gateway. """
+
+import gc
+import utime
+
+# upper bounds of the forward latency buckets in ms, the last bucket counts
+# everything above
+LATENCY_BOUNDS_MS = (2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram of integer samples, percentiles are reported as
+    the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Returns the bucket bound under which p percent of the samples are,
+        capped at the maximum seen, or 0 without samples.
+        """
+
+        if not self.count:
+            return 0
+        need = -(-self.count * p // 100)
+        seen = 0
+        for i in range(len(self.counts)):
+            seen += self.counts[i]
+            if seen >= need:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def mean(self):
+        return self.total // self.count if self.count else 0
+
+
+class HeapMonitor:
+    """
+    Runs the garbage collector at regular times, so that collections are
+    short and do not happen at random in the packet path, and records how
+    long they take and the free heap left.
+    """
+
+    def __init__(self):
+        self.free = 0
+        self.min_free = -1
+        self.collections = 0
+        self.gc_last_us = 0
+        self.gc_max_us = 0
+        self.gc_total_us = 0
+
+    def collect(self):
+        start = utime.ticks_us()
+        gc.collect()
+        pause = utime.ticks_diff(utime.ticks_us(), start)
+        self.collections += 1
+        self.gc_last_us = pause
+        self.gc_total_us += pause
+        if pause > self.gc_max_us:
+            self.gc_max_us = pause
+        self.sample()
+
+    def sample(self):
+        # not every port reports the free heap
+        free = gc.mem_free() if hasattr(gc, 'mem_free') else 0
+        self.free = free
+        if self.min_free < 0 or free < self.min_free:
+            self.min_free = free
@@ -2,9 +2,8 @@
 
 import errno
 import machine
-import ubinascii
 import ujson
-import uos
+import uselect
 import usocket
 import utime
 import _thread
@@ -12,59 +11,64 @@ from micropython import const
 from network import LoRa
 from network import WLAN
 from machine import Timer
+from airtime import DutyCycle
+from airtime import datr_to_sf_bw
+from capture import CAPTURE_BYTES
+from capture import Capture
+from downlink import ClassCQueue
+from downlink import DownlinkScheduler
+from downlink import TxCalibration
+from downlink import decode_txpk
+from dedup import DedupCache
+from keepalive import AdaptiveInterval
+from lorawan import DROP_NAMES
+from lorawan import FrameFilter
+from logger import INFO
+from logger import Logger
+from metrics import HeapMonitor
+from metrics import Histogram
+from rxring import RxRing
+from rxscan import RxScan
+from semtech import JsonWriter
+from semtech import PacketBuilder
+from semtech import TX_ERR_DUTY_CYCLE
+from semtech import TX_ERR_INVALID
+from semtech import TX_ERR_NONE
+from semtech import TX_ERR_NOT_ACTIVE
+from semtech import TX_ERR_TX_FREQ
+from semtech import write_rxpk
+from semtech import write_stat
+from server import Server
+from spool import Spool
 
 
-PROTOCOL_VERSION = const(2)
-
 PUSH_DATA = const(0)
 PUSH_ACK = const(1)
 PULL_DATA = const(2)
 PULL_ACK = const(4)
 PULL_RESP = const(3)
+TX_ACK = const(5)
 
-TX_ERR_NONE = 'NONE'
-TX_ERR_TOO_LATE = 'TOO_LATE'
-TX_ERR_TOO_EARLY = 'TOO_EARLY'
-TX_ERR_COLLISION_PACKET = 'COLLISION_PACKET'
-TX_ERR_COLLISION_BEACON = 'COLLISION_BEACON'
-TX_ERR_TX_FREQ = 'TX_FREQ'
-TX_ERR_TX_POWER = 'TX_POWER'
-TX_ERR_GPS_UNLOCKED = 'GPS_UNLOCKED'
-
-UDP_THREAD_CYCLE_MS = const(20)
-
-STAT_PK = {
-    'stat': {
-        'time': '',
-        'lati': 0,
-        'long': 0,
-        'alti': 0,
-        'rxnb': 0,
-        'rxok': 0,
-        'rxfw': 0,
-        'ackr': 100.0,
-        'dwnb': 0,
-        'txnb': 0
-    }
-}
+UDP_POLL_TIMEOUT_MS = const(500)
 
-RX_PK = {
-    'rxpk': [{
-        'time': '',
-        'tmst': 0,
-        'chan': 0,
-        'rfch': 0,
-        'freq': 0,
-        'stat': 1,
-        'modu': 'LORA',
-        'datr': '',
-        'codr': '4/5',
-        'rssi': 0,
-        'lsnr': 0,
-        'size': 0,
-        'data': ''
-    }]
-}
+PUSH_BATCH_MAX = const(8)
+# the push window is checked this many times per window
+PUSH_WINDOW_TICKS = const(4)
+PUSH_ACK_TIMEOUT_MS = const(2000)
+
+SPOOL_BYTES = const(65536)
+SPOOL_RATE_MS = const(200)
+
+SUPERVISOR_PERIOD_MS = const(5000)
+WIFI_CONNECT_TIMEOUT_MS = const(15000)
+BACKOFF_MIN_MS = const(1000)
+BACKOFF_MAX_MS = const(120000)
+
+RX_RING_SLOTS = const(8)
+
+# forward every uplink to all the servers, or only to the first healthy one
+SERVER_MODE_FANOUT = 'fanout'
+SERVER_MODE_FAILOVER = 'failover'
 
 TX_ACK_PK = {
     'txpk_ack': {
@@ -81,10 +85,30 @@ class NanoGateway:
     connecting to the Internet.
     """
 
-    def __init__(self, id, frequency, datarate, ssid, password, server, port, ntp_server='pool.ntp.org', ntp_period=3600):
+    def __init__(self, id, frequency, datarate, ssid, password, server, port, ntp_server='pool.ntp.org', ntp_period=3600,
+                 push_window_ms=0, push_batch_max=PUSH_BATCH_MAX, rx_ring_slots=RX_RING_SLOTS, tx_calibrate=True,
+                 push_ack_timeout_ms=PUSH_ACK_TIMEOUT_MS, push_retransmit=False,
+                 spool_path=None, spool_bytes=SPOOL_BYTES, spool_rate_ms=SPOOL_RATE_MS,
+                 pull_ack_timeout_s=90, dns_period_s=3600, servers=None, server_mode=SERVER_MODE_FANOUT,
+                 devaddr_allow=(), devaddr_deny=(), joineui_allow=(), joineui_deny=(),
+                 dedup_window_ms=0, stat_extended=False, duty_cycle=False, rx_scan=None, rx_scan_cycle_ms=4000,
+                 log_level=INFO, log_path=None, query_port=None,
+                 pull_min_s=10, pull_max_s=25, stat_min_s=60, stat_max_s=300,
+                 class_c_queue_size=16, class_c_tx_percent=50, capture_path=None, capture_bytes=CAPTURE_BYTES):
         self.id = id
-        self.server = server
-        self.port = port
+
+        # log records are kept unformatted in a ring and written out by a
+        # flusher thread, to the UART or to log_path on flash
+        self.log = Logger(log_level)
+        self.log_path = log_path
+
+        # servers is a list of (host, port), it replaces server and port
+        # when given. Downlinks are only accepted from the active server,
+        # the first one of the list that is healthy.
+        if not servers:
+            servers = [(server, port)]
+        self.servers = [Server(host, p, push_ack_timeout_ms, push_retransmit) for host, p in servers]
+        self.server_mode = server_mode
 
         self.frequency = frequency
         self.datarate = datarate
@@ -95,29 +119,136 @@ class NanoGateway:
         self.ntp_server = ntp_server
         self.ntp_period = ntp_period
 
-        self.server_ip = None
-
         self.rxnb = 0
         self.rxok = 0
         self.rxfw = 0
         self.dwnb = 0
         self.txnb = 0
 
+        # uplinks received within push_window_ms of each other are sent
+        # together in one PUSH_DATA rxpk array, up to push_batch_max frames
+        self.push_window_ms = push_window_ms
+        self.push_batch_max = max(1, push_batch_max)
+        self.push_pending = 0
+        self.push_batch = JsonWriter(512 * self.push_batch_max)
+        self.push_lock = _thread.allocate_lock()
+        # one periodic alarm, only enabled while a batch is pending, flags
+        # the batch as due and leaves the push to the RX worker
+        self.push_alarm = None
+        self.push_start_ms = 0
+        self.push_due = False
+        self.push_batches = 0
+        self.push_saved = 0
+
+        # tmst of the frames in the pending batch, to measure how long they
+        # took from the radio to the UDP socket
+        self.push_tmst = [0] * self.push_batch_max
+        self.fwd_latency = Histogram()
+        self.heap = HeapMonitor()
+
+        # the counters of stats() are also sent as JSON in reply to any
+        # datagram received on query_port
+        self.query_port = query_port
+        self.query_sock = None
+
+        # uplinks that could not be sent are kept on flash and replayed,
+        # at most one every spool_rate_ms, once the server answers again
+        self.spool_path = spool_path
+        self.spool_bytes = spool_bytes
+        self.spool_rate_ms = spool_rate_ms
+        self.spool = None
+        self.spool_ms = 0
+
+        # the supervisor thread reconnects WiFi and reopens the UDP socket of
+        # a server when the WiFi drops, the server stops answering PULL_DATA
+        # or its DNS name resolves to a new address
+        self.pull_ack_timeout_ms = pull_ack_timeout_s * 1000
+        self.dns_period_ms = dns_period_s * 1000
+        self.sup_stop = False
+        self.reconnects = 0
+
+        # the radio callback only copies frames in here, the RX worker
+        # thread encodes and forwards them
+        self.rx_ring = RxRing(rx_ring_slots)
+        self.rx_event = _thread.allocate_lock()
+        self.rx_event.acquire()
+        self.rx_stop = False
+
+        # frames of foreign networks are dropped before they are encoded,
+        # by DevAddr prefix for data uplinks and JoinEUI for join requests
+        self.filter = None
+        if devaddr_allow or devaddr_deny or joineui_allow or joineui_deny:
+            self.filter = FrameFilter(devaddr_allow, devaddr_deny, joineui_allow, joineui_deny)
+
+        # every frame received, before filtering, is recorded in binary to
+        # capture_path on flash, keeping at most capture_bytes
+        self.capture = None
+        if capture_path:
+            self.capture = Capture(capture_path, datr_to_sf_bw(datarate)[1], max_bytes=capture_bytes)
+
+        # the same PHYPayload heard again within dedup_window_ms is dropped
+        self.dedup = DedupCache(window_ms=dedup_window_ms) if dedup_window_ms > 0 else None
+
+        # add the gateway's own counters to the stat packets
+        self.stat_extended = stat_extended
+
         self.sf = self._dr_to_sf(self.datarate)
         self.bw = self._dr_to_bw(self.datarate)
-
+        self.rx_datr = [self._sf_bw_to_dr(sf, self.bw).encode() for sf in range(13)]
+
+        # the radio listens on rx_freq and rx_sf, which rotate through the
+        # (frequency, sf) slots of rx_scan when it is given
+        self.rx_freq = self.frequency
+        self.rx_sf = self.sf
+        self.scan = None
+        self.scan_alarm = None
+        if rx_scan:
+            self.scan = RxScan(rx_scan, datr_to_sf_bw(self.datarate)[1], cycle_ms=rx_scan_cycle_ms)
+
+        # PULL_DATA comes every pull_min_s while downlinks arrive or after a
+        # PULL_ACK went missing, and less often up to pull_max_s when idle.
+        # The stat interval likewise follows the uplink and downlink traffic.
+        self.pull_interval = AdaptiveInterval(pull_min_s * 1000, pull_max_s * 1000)
+        self.stat_interval = AdaptiveInterval(stat_min_s * 1000, stat_max_s * 1000)
+        self.pull_sent_ms = 0
+        self.pull_dwnb = 0
+        self.pull_missed = False
+        self.stat_count = 0
+        self.timers_stop = False
         self.stat_alarm = None
         self.pull_alarm = None
-        self.uplink_alarm = None
+        self.downlinks = None
+
+        # class C downlinks wait in a FIFO and are paced so that at most
+        # class_c_tx_percent of the radio time goes to them
+        self.class_c = None
+        self.class_c_queue_size = class_c_queue_size
+        self.class_c_tx_percent = class_c_tx_percent
+        self.tx_timing = TxCalibration(calibrate=tx_calibrate)
+
+        # EU868 sub-band duty cycle limits, downlinks over the budget are
+        # refused in their txpk_ack
+        self.duty = DutyCycle() if duty_cycle else None
 
         self.wlan = None
-        self.sock = None
+        self.pkt = None
         self.udp_stop = False
         self.udp_lock = _thread.allocate_lock()
 
         self.lora = None
         self.lora_sock = None
 
+        # radio settings last applied, [frequency, bandwidth, sf, tx_iq, device_class]
+        self.radio_cfg = None
+        self.radio_inits = 0
+        self.radio_fast = 0
+
+        # how long the radio could not receive around each downlink
+        self.deaf_start = None
+        self.deaf_last_us = 0
+        self.deaf_max_us = 0
+        self.deaf_total_us = 0
+
         self.rtc = machine.RTC()
 
     def start(self):
@@ -125,39 +256,96 @@ class NanoGateway:
         Starts the LoRaWAN nano gateway.
         """
 
-        self._log('Starting LoRaWAN nano gateway with id: {}', self.id)
+        self.log.start(self.log_path)
+        self.log.info('Starting LoRaWAN nano gateway with id: {}', self.id)
 
         # setup WiFi as a station and connect
         self.wlan = WLAN(mode=WLAN.STA)
-        self._connect_to_wifi()
+        backoff = BACKOFF_MIN_MS
+        while not self._connect_to_wifi(WIFI_CONNECT_TIMEOUT_MS):
+            # the access point may still be booting, retry with a backoff
+            self.log.warning('WiFi connect failed, next attempt in {} s', backoff // 1000)
+            self.wlan.disconnect()
+            utime.sleep_ms(backoff)
+            backoff = min(backoff * 2, BACKOFF_MAX_MS)
 
         # get a time sync
-        self._log('Syncing time with {} ...', self.ntp_server)
+        self.log.info('Syncing time with {} ...', self.ntp_server)
         self.rtc.ntp_sync(self.ntp_server, update_period=self.ntp_period)
         while not self.rtc.synced():
             utime.sleep_ms(50)
-        self._log("RTC NTP sync complete")
-
-        # get the server IP and create an UDP socket
-        self.server_ip = usocket.getaddrinfo(self.server, self.port)[0][-1]
-        self._log('Opening UDP socket to {} ({}) port {}...', self.server, self.server_ip[0], self.server_ip[1])
-        self.sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM, usocket.IPPROTO_UDP)
-        self.sock.setsockopt(usocket.SOL_SOCKET, usocket.SO_REUSEADDR, 1)
-        self.sock.setblocking(False)
-
-        # push the first time immediatelly
-        self._push_data(self._make_stat_packet())
-
-        # create the alarms
-        self.stat_alarm = Timer.Alarm(handler=lambda t: self._push_data(self._make_stat_packet()), s=60, periodic=True)
-        self.pull_alarm = Timer.Alarm(handler=lambda u: self._pull_data(), s=25, periodic=True)
+        self.log.info("RTC NTP sync complete")
+
+        # get the server IPs and create an UDP socket for each
+        for server in self.servers:
+            server.ip = server.resolve()
+            self.log.info('Opening UDP socket to {} ({}) port {}...', server.host, server.ip[0], server.ip[1])
+            server.sock = server.open()
+
+        if self.query_port:
+            self.query_sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM, usocket.IPPROTO_UDP)
+            self.query_sock.bind(usocket.getaddrinfo('0.0.0.0', self.query_port)[0][-1])
+            self.query_sock.setblocking(False)
+
+        # the UDP packets are all assembled in one reusable buffer
+        self.pkt = PacketBuilder(self.id)
+
+        if self.spool_path:
+            self.spool = Spool(self.spool_path, segment_bytes=self.spool_bytes // 4, segments=4)
+            if not self.spool.empty():
+                self.log.info('Uplinks spooled in {} will be replayed', self.spool_path)
+
+        # the supervisor samples the heap after each collection, take the
+        # first sample now so the first stat packet has one
+        self.heap.sample()
+
+        # push the first time immediatelly, and pull so that downlinks can
+        # reach us before the first pull alarm
+        self._push_stat()
+        self._pull_data()
+
+        # create the alarms, each one rearms itself with its next interval
+        self.timers_stop = False
+        self.stat_count = self.rxnb + self.dwnb
+        self.pull_dwnb = self.dwnb
+        self.stat_alarm = Timer.Alarm(handler=lambda t: self._stat_timer(), ms=self.stat_interval.interval_ms)
+        self.pull_alarm = Timer.Alarm(handler=lambda u: self._pull_timer(), ms=self.pull_interval.interval_ms)
+
+        if self.push_window_ms > 0 and self.push_batch_max > 1:
+            self.push_alarm = Timer.Alarm(handler=None, ms=max(1, self.push_window_ms // PUSH_WINDOW_TICKS), periodic=True)
+
+        # class A downlinks are transmitted in tmst order from a single alarm
+        self.downlinks = DownlinkScheduler(
+            clock=utime.ticks_cpu,
+            alarm=lambda handler, us: Timer.Alarm(handler=handler, us=us),
+            send=self._send_down_link,
+            lead_us=self.tx_timing.lead_us
+        )
+        self.class_c = ClassCQueue(
+            clock=utime.ticks_cpu,
+            alarm=lambda handler, us: Timer.Alarm(handler=handler, us=us),
+            send=self._send_down_link_class_c,
+            free=self.downlinks.free,
+            size=self.class_c_queue_size,
+            tx_percent=self.class_c_tx_percent
+        )
 
         # start the UDP receive thread
         self.udp_stop = False
         _thread.start_new_thread(self._udp_thread, ())
 
+        # start the thread that forwards the received LoRa frames
+        self.rx_stop = False
+        _thread.start_new_thread(self._rx_thread, ())
+
+        # start watching the WiFi and the server connections
+        for server in self.servers:
+            server.pull_ack_ms = utime.ticks_ms()
+        self.sup_stop = False
+        _thread.start_new_thread(self._supervisor_thread, ())
+
         # initialize the LoRa radio in LORA mode
-        self._log('Setting up the LoRa radio at {} Mhz using {}', self._freq_to_float(self.frequency), self.datarate)
+        self.log.info('Setting up the LoRa radio at {} Mhz using {}', self._freq_to_float(self.frequency), self.datarate)
         self.lora = LoRa(
             mode=LoRa.LORA,
             frequency=self.frequency,
@@ -167,6 +355,7 @@ class NanoGateway:
             coding_rate=LoRa.CODING_4_5,
             tx_iq=True
         )
+        self.radio_cfg = [self.frequency, self.bw, self.sf, True, LoRa.CLASS_A]
 
         # create a raw LoRa socket
         self.lora_sock = usocket.socket(usocket.AF_LORA, usocket.SOCK_RAW)
@@ -174,16 +363,27 @@ class NanoGateway:
         self.lora_tx_done = False
 
         self.lora.callback(trigger=(LoRa.RX_PACKET_EVENT | LoRa.TX_PACKET_EVENT), handler=self._lora_cb)
-        self._log('LoRaWAN nano gateway online')
+
+        if self.scan:
+            self.log.info('Scanning {} receive slots every {} ms', len(self.scan), self.scan.cycle_ms)
+            self._rx_hop(None)
+        self.log.info('LoRaWAN nano gateway online')
 
     def stop(self):
         """
         Stops the LoRaWAN nano gateway.
         """
 
-        self._log('Stopping...')
+        self.log.info('Stopping...')
+
+        # stop the supervisor first so it does not reconnect what we close
+        self.sup_stop = True
+        while self.sup_stop:
+            utime.sleep_ms(50)
 
         # send the LoRa radio to sleep
+        if self.scan_alarm:
+            self.scan_alarm.cancel()
         self.lora.callback(trigger=None, handler=None)
         self.lora.power_mode(LoRa.SLEEP)
 
@@ -191,23 +391,138 @@ class NanoGateway:
         self.rtc.ntp_sync(None)
 
         # cancel all the alarms
+        self.timers_stop = True
         self.stat_alarm.cancel()
         self.pull_alarm.cancel()
+        if self.push_alarm:
+            self.push_alarm.cancel()
+        self.downlinks.cancel()
+        self.class_c.cancel()
+
+        # let the RX worker drain the ring, then send whatever is still
+        # waiting in the aggregation window
+        self.rx_stop = True
+        self._rx_wakeup()
+        while self.rx_stop:
+            utime.sleep_ms(50)
+        self._flush_rxpk()
 
         # signal the UDP thread to stop
         self.udp_stop = True
         while self.udp_stop:
             utime.sleep_ms(50)
 
+        if self.spool:
+            self.spool.flush()
+        if self.capture:
+            self.capture.flush()
+
         # disable WLAN
         self.wlan.disconnect()
         self.wlan.deinit()
 
-    def _connect_to_wifi(self):
+        self.log.info('Stopped')
+        self.log.stop()
+
+    def _connect_to_wifi(self, timeout_ms=None):
+        """
+        Connects to the WiFi network, waiting forever unless a timeout is
+        given. Returns whether the connection is up.
+        """
+
         self.wlan.connect(self.ssid, auth=(None, self.password))
+        start = utime.ticks_ms()
         while not self.wlan.isconnected():
+            if timeout_ms is not None and utime.ticks_diff(utime.ticks_ms(), start) > timeout_ms:
+                return False
             utime.sleep_ms(50)
-        self._log('WiFi connected to: {}', self.ssid)
+        self.log.info('WiFi connected to: {}', self.ssid)
+        return True
+
+    def _reopen_socket(self, server):
+        """
+        Resolves the server again and replaces its UDP socket. The UDP
+        thread picks up the new socket and closes the old one.
+        """
+
+        ip = server.resolve()
+        self.log.info('Opening UDP socket to {} ({}) port {}...', server.host, ip[0], ip[1])
+        sock = server.open()
+        with self.udp_lock:
+            server.ip = ip
+            server.sock = sock
+            # announce ourselves right away so downlinks can reach us again
+            self.pkt.begin(PULL_DATA)
+            self._send_pkt(server)
+        server.reopens += 1
+
+    def _supervisor_wait(self, ms):
+        while ms > 0 and not self.sup_stop:
+            utime.sleep_ms(min(ms, 500))
+            ms -= 500
+
+    def _supervisor_thread(self):
+        """
+        Supervisor thread, restores the WiFi and the server connection with
+        an exponential backoff. The LoRa radio keeps receiving meanwhile,
+        the uplinks that cannot be sent go to the spool.
+        """
+
+        backoff = BACKOFF_MIN_MS
+        while not self.sup_stop:
+            self._supervisor_wait(SUPERVISOR_PERIOD_MS)
+            if self.sup_stop:
+                break
+            # collect now rather than at random in the packet path
+            self.heap.collect()
+            if self.capture:
+                self.capture.maybe_flush()
+            try:
+                if not self.wlan.isconnected():
+                    for server in self.servers:
+                        server.up = False
+                    self.log.warning('WiFi connection lost, reconnecting')
+                    self.wlan.disconnect()
+                    if not self._connect_to_wifi(WIFI_CONNECT_TIMEOUT_MS):
+                        self.log.warning('WiFi reconnect failed, next attempt in {} s', backoff // 1000)
+                        self._supervisor_wait(backoff)
+                        backoff = min(backoff * 2, BACKOFF_MAX_MS)
+                        continue
+                    self.reconnects += 1
+                    for server in self.servers:
+                        self._reopen_socket(server)
+                        server.pull_ack_ms = utime.ticks_ms()
+                    continue
+
+                failed = False
+                # with long keepalive intervals a single lost PULL_DATA must
+                # not be taken for a dead server
+                timeout_ms = max(self.pull_ack_timeout_ms, 2 * self.pull_interval.interval_ms)
+                for server in self.servers:
+                    now = utime.ticks_ms()
+                    if utime.ticks_diff(now, server.pull_ack_ms) > timeout_ms:
+                        server.up = False
+                        self.log.warning('No PULL_ACK from {} for {} s, reopening the UDP socket', server.host, utime.ticks_diff(now, server.pull_ack_ms) // 1000)
+                        self._reopen_socket(server)
+                        # give the new socket a full timeout, plus the backoff
+                        server.pull_ack_ms = utime.ticks_add(now, backoff)
+                        failed = True
+                    elif utime.ticks_diff(now, server.dns_ms) > self.dns_period_ms:
+                        ip = server.resolve()
+                        if ip != server.ip:
+                            self.log.info('{} moved to {}', server.host, ip[0])
+                            self._reopen_socket(server)
+                if failed:
+                    backoff = min(backoff * 2, BACKOFF_MAX_MS)
+                elif self._backhaul_up():
+                    backoff = BACKOFF_MIN_MS
+            except Exception as ex:
+                self.log.error('Supervisor Exception: {}', ex)
+                self._supervisor_wait(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX_MS)
+
+        self.sup_stop = False
+        self.log.info('Supervisor thread stopped')
 
     def _dr_to_sf(self, dr):
         sf = dr[2:4]
@@ -224,6 +539,14 @@ class NanoGateway:
         else:
             return LoRa.BW_500KHZ
 
+    def _khz_to_bw(self, khz):
+        if khz == 125:
+            return LoRa.BW_125KHZ
+        elif khz == 250:
+            return LoRa.BW_250KHZ
+        else:
+            return LoRa.BW_500KHZ
+
     def _sf_bw_to_dr(self, sf, bw):
         dr = 'SF' + str(sf)
         if bw == LoRa.BW_125KHZ:
@@ -244,22 +567,126 @@ class NanoGateway:
             self.rxok += 1
             rx_data = self.lora_sock.recv(256)
             stats = lora.stats()
-            packet = self._make_node_packet(rx_data, self.rtc.now(), stats.rx_timestamp, stats.sfrx, self.bw, stats.rssi, stats.snr)
-            packet = self.frequency_rounding_fix(packet, self.frequency)
-            self._push_data(packet)
-            self._log('Received packet: {}', packet)
-            self.rxfw += 1
+            if self.scan:
+                self.scan.hit()
+            if self.rx_ring.put(rx_data, self.rtc.now(), stats.rx_timestamp, self.rx_freq, stats.sfrx, stats.rssi, stats.snr):
+                self._rx_wakeup()
         if events & LoRa.TX_PACKET_EVENT:
+            tx_error = self.tx_timing.tx_done(utime.ticks_cpu())
             self.txnb += 1
-            lora.init(
+            self._setup_radio(self.rx_freq, self.bw, self.rx_sf)
+            deaf = self._deaf_end()
+            if tx_error is not None:
+                # apply the latest latency estimate to the next downlinks
+                self.downlinks.lead_us = self.tx_timing.lead_us
+                self.log.debug('Downlink started {} us {} tmst, TX lead {} us', abs(tx_error), 'after' if tx_error >= 0 else 'before', self.tx_timing.lead_us)
+            self.log.debug('Radio back to RX, deaf for {} us', deaf)
+
+    def _setup_radio(self, frequency, bandwidth, sf, tx_iq=True, device_class=LoRa.CLASS_A):
+        """
+        Applies the radio settings, only reconfiguring what differs from the
+        current configuration. A full init is only needed when the IQ
+        inversion or the device class change.
+        """
+
+        cfg = self.radio_cfg
+        if cfg is None or cfg[3] != tx_iq or cfg[4] != device_class:
+            self.lora.init(
                 mode=LoRa.LORA,
-                frequency=self.frequency,
-                bandwidth=self.bw,
-                sf=self.sf,
+                frequency=frequency,
+                bandwidth=bandwidth,
+                sf=sf,
                 preamble=8,
                 coding_rate=LoRa.CODING_4_5,
-                tx_iq=True
+                tx_iq=tx_iq,
+                device_class=device_class
                 )
+            self.radio_cfg = [frequency, bandwidth, sf, tx_iq, device_class]
+            self.radio_inits += 1
+            return
+
+        if cfg[0] != frequency:
+            self.lora.frequency(frequency)
+            cfg[0] = frequency
+        if cfg[1] != bandwidth:
+            self.lora.bandwidth(bandwidth)
+            cfg[1] = bandwidth
+        if cfg[2] != sf:
+            self.lora.sf(sf)
+            cfg[2] = sf
+        self.radio_fast += 1
+
+    def _rx_hop(self, alarm):
+        """
+        Tunes the receiver to the next scan slot and arms the alarm for the
+        end of its dwell. While a downlink is on air only the slot changes,
+        the radio returns to it after the transmission.
+        """
+
+        freq, sf, dwell_ms = self.scan.next()
+        self.rx_freq = freq
+        self.rx_sf = sf
+        if self.deaf_start is None:
+            self._setup_radio(freq, self.bw, sf)
+        self.scan_alarm = Timer.Alarm(handler=self._rx_hop, ms=dwell_ms)
+
+    def _deaf_begin(self):
+        self.deaf_start = utime.ticks_us()
+
+    def _deaf_end(self):
+        """
+        Accounts the time since the radio left RX for a downlink, returns it
+        in microseconds.
+        """
+
+        if self.deaf_start is None:
+            return 0
+        deaf = utime.ticks_diff(utime.ticks_us(), self.deaf_start)
+        self.deaf_start = None
+        self.deaf_last_us = deaf
+        self.deaf_total_us += deaf
+        if deaf > self.deaf_max_us:
+            self.deaf_max_us = deaf
+        return deaf
+
+    def _rx_wakeup(self):
+        try:
+            self.rx_event.release()
+        except RuntimeError:
+            # the worker has not consumed the previous wakeup yet
+            pass
+
+    def _rx_thread(self):
+        """
+        RX worker thread, encodes the frames queued by the radio callback
+        and forwards them to the server.
+        """
+
+        ring = self.rx_ring
+        while True:
+            self.rx_event.acquire()
+            while True:
+                i = ring.peek()
+                if i < 0:
+                    break
+                try:
+                    data = ring.payload(i)
+                    if self.capture:
+                        self.capture.add(ring.time[i], ring.tmst[i], ring.freq[i], ring.sf[i], ring.rssi[i], ring.snr[i], data)
+                    if (self.filter is None or self.filter.accept(data)) and \
+                       (self.dedup is None or not self.dedup.duplicate(data)):
+                        self._queue_rxpk(data, ring.time[i], ring.tmst[i], ring.freq[i], ring.sf[i], ring.rssi[i], ring.snr[i])
+                        self.log.debug('Received packet: tmst {} SF{} rssi {} snr {} size {}', ring.tmst[i], ring.sf[i], ring.rssi[i], ring.snr[i], ring.size[i])
+                except Exception as ex:
+                    self.log.error('RX encode Exception: {}', ex)
+                ring.pop()
+            if self.push_due:
+                self._flush_rxpk()
+            if self.rx_stop:
+                break
+
+        self.rx_stop = False
+        self.log.info('RX thread stopped')
 
     def _freq_to_float(self, frequency):
         """
@@ -278,179 +705,584 @@ class NanoGateway:
             frequency = frequency / (10 ** divider)
         return frequency
 
-    def frequency_rounding_fix(self, packet, frequency):
-        freq = str(frequency)[0:3] + '.' + str(frequency)[3]
-
-        start = packet.find("freq\":")
-        end = packet.find(",", start)
-
-        packet = packet[:start + 7] + freq + packet[end:]
-
-        return packet
-
-    def _make_stat_packet(self):
-        now = self.rtc.now()
-        STAT_PK["stat"]["time"] = "%d-%02d-%02d %02d:%02d:%02d GMT" % (now[0], now[1], now[2], now[3], now[4], now[5])
-        STAT_PK["stat"]["rxnb"] = self.rxnb
-        STAT_PK["stat"]["rxok"] = self.rxok
-        STAT_PK["stat"]["rxfw"] = self.rxfw
-        STAT_PK["stat"]["dwnb"] = self.dwnb
-        STAT_PK["stat"]["txnb"] = self.txnb
-        return ujson.dumps(STAT_PK)
-
-    def _make_node_packet(self, rx_data, rx_time, tmst, sf, bw, rssi, snr):
-        RX_PK["rxpk"][0]["time"] = "%d-%02d-%02dT%02d:%02d:%02d.%dZ" % (rx_time[0], rx_time[1], rx_time[2], rx_time[3], rx_time[4], rx_time[5], rx_time[6])
-        RX_PK["rxpk"][0]["tmst"] = tmst
-        RX_PK["rxpk"][0]["freq"] = self._freq_to_float(self.frequency)
-        RX_PK["rxpk"][0]["datr"] = self._sf_bw_to_dr(sf, bw)
-        RX_PK["rxpk"][0]["rssi"] = rssi
-        RX_PK["rxpk"][0]["lsnr"] = snr
-        RX_PK["rxpk"][0]["data"] = ubinascii.b2a_base64(rx_data)[:-1]
-        RX_PK["rxpk"][0]["size"] = len(rx_data)
-        return ujson.dumps(RX_PK)
-
-    def _push_data(self, data):
-        token = uos.urandom(2)
-        packet = bytes([PROTOCOL_VERSION]) + token + bytes([PUSH_DATA]) + ubinascii.unhexlify(self.id) + data
+    def _log_stat(self):
+        """
+        Logs the counters behind the status. Only called when INFO records
+        are kept, the arguments take joins, sorts and copies to compute.
+        """
+
+        if self.push_batches:
+            self.log.info('Pushed {} uplink batches, saved {} datagrams', self.push_batches, self.push_saved)
+        if self.rx_ring.drops:
+            self.log.info('RX ring dropped {} frames, high water {}/{}', self.rx_ring.drops, self.rx_ring.high_water,
+                          self.rx_ring.slots)
+        if self.filter and self.filter.dropped():
+            self.log.info('Filter passed {} frames, dropped {}, rule hits {}', self.filter.passed,
+                          ', '.join('{} {}'.format(DROP_NAMES[i], n) for i, n in enumerate(self.filter.drops) if n),
+                          ', '.join('{} {} {}'.format(name, rule, n) for name, rule, n in self.filter.rule_hits()))
+        if self.dedup and self.dedup.duplicates:
+            self.log.info('Dropped {} duplicate frames out of {}', self.dedup.duplicates, self.dedup.checked)
+        if self.duty and self.duty.refused:
+            self.log.info('Refused {} downlinks over the duty cycle, sub-band usage {} per mille', self.duty.refused,
+                          self.duty.usage())
+        if self.scan and self.scan.cycles:
+            self.log.info('RX scan hits {}, dwell {} ms', tuple(self.scan.hits), tuple(self.scan.dwell_ms))
+        if self.fwd_latency.count:
+            self.log.info('Forward latency p50/p90/p99 {}/{}/{} ms, max {} ms, heap free {} min {}, GC max {} us',
+                          self.fwd_latency.percentile(50), self.fwd_latency.percentile(90),
+                          self.fwd_latency.percentile(99), self.fwd_latency.max, self.heap.free, self.heap.min_free,
+                          self.heap.gc_max_us)
+        if self.tx_timing.count:
+            self.log.info('Downlink timing error min/mean/max {} us, TX lead {} us', self.tx_timing.error_stats(),
+                          self.tx_timing.lead_us)
+        if self.class_c and self.class_c.queued:
+            self.log.info('Class C downlinks sent {} of {}, {} refused queue full, {} deferred, wait mean/max {}/{} us',
+                          self.class_c.sent, self.class_c.queued, self.class_c.full, self.class_c.deferred,
+                          self.class_c.wait_mean_us(), self.class_c.wait_max_us)
+        if self.txnb:
+            self.log.info('Radio deaf {} us in total, {} us max, {} full inits, {} fast reconfigurations',
+                          self.deaf_total_us, self.deaf_max_us, self.radio_inits, self.radio_fast)
+        if self.reconnects:
+            self.log.info('WiFi reconnected {} times', self.reconnects)
+        for server in self.servers:
+            if server.acks.pushed or server.refused:
+                self.log.info('{}: {}, PUSH_DATA acked {} lost {} retransmitted {}, RTT p50/p90/p99 {} ms, '
+                              '{} downlinks refused',
+                              server.host, 'up' if server.up else 'down', server.acks.acked, server.acks.lost,
+                              server.acks.retransmitted, server.acks.rtt_percentiles(), server.refused)
+        if self.capture and self.capture.records:
+            self.log.info('Captured {} frames, {} dropped, {} bytes written to {}, {} rotations, {} write errors',
+                          self.capture.records, self.capture.dropped(), self.capture.written, self.capture.path,
+                          self.capture.rotations, self.capture.errors)
+        if self.spool and (self.spool.appended or self.spool.dropped()):
+            self.log.info('Spooled {} uplinks, {} dropped, replayed {}, {} segments dropped, {} corrupt',
+                          self.spool.appended, self.spool.dropped(), self.spool.replayed,
+                          self.spool.dropped_segments, self.spool.corrupt)
+
+    def _push_stat(self):
+        """
+        Pushes the gateway status, written straight into the packet buffer.
+        """
+
+        if INFO >= self.log.level:
+            self._log_stat()
+
+        extra = self._stat_extra() if self.stat_extended else None
+
+        # every server gets the status, each with its own ackr
         with self.udp_lock:
+            for server in self.servers:
+                self.pkt.begin(PUSH_DATA)
+                write_stat(self.pkt, self.rtc.now(), self.rxnb, self.rxok, self.rxfw, server.acks.ackr(), self.dwnb, self.txnb, extra)
+                self._send_pkt(server, True)
+
+    def _stat_extra(self):
+        """
+        Returns the non standard counters of the extended stat packet.
+        """
+
+        extra = []
+        if self.dedup:
+            extra.append((b'dedup_checked', self.dedup.checked))
+            extra.append((b'dedup_dropped', self.dedup.duplicates))
+        if self.filter:
+            extra.append((b'filter_passed', self.filter.passed))
+            for i in range(len(DROP_NAMES)):
+                extra.append(('filter_' + DROP_NAMES[i], self.filter.drops[i]))
+            # per rule hits, numbered in the order of each configuration list
+            index = {}
+            for name, rule, n in self.filter.rule_hits():
+                k = index.get(name, 0)
+                index[name] = k + 1
+                extra.append(('filter_{}_{}'.format(name, k), n))
+        if self.duty:
+            extra.append((b'duty_refused', self.duty.refused))
+        latency = self.fwd_latency
+        extra.append((b'fwd_ms_p50', latency.percentile(50)))
+        extra.append((b'fwd_ms_p90', latency.percentile(90)))
+        extra.append((b'fwd_ms_p99', latency.percentile(99)))
+        extra.append((b'fwd_ms_max', latency.max))
+        extra.append((b'rx_queue_hw', self.rx_ring.high_water))
+        extra.append((b'rx_drops', self.rx_ring.drops))
+        extra.append((b'heap_free', self.heap.free))
+        extra.append((b'heap_min', self.heap.min_free))
+        extra.append((b'gc_max_us', self.heap.gc_max_us))
+        extra.append((b'udp_errors', self._send_errors()))
+        extra.append((b'wifi_reconnects', self.reconnects))
+        return extra
+
+    def _send_errors(self):
+        errors = 0
+        for server in self.servers:
+            errors += server.send_errors
+        return errors
+
+    def stats(self):
+        """
+        Returns the performance counters of the gateway as a dict, for the
+        REPL and the local query port.
+        """
+
+        latency = self.fwd_latency
+        return {
+            'rx': {'rxnb': self.rxnb, 'rxok': self.rxok, 'rxfw': self.rxfw, 'push_batches': self.push_batches,
+                   'push_saved': self.push_saved},
+            'tx': {'dwnb': self.dwnb, 'txnb': self.txnb, 'timing_error_us': self.tx_timing.error_stats(),
+                   'lead_us': self.tx_timing.lead_us},
+            'radio': {
+                'inits': self.radio_inits,
+                'fast': self.radio_fast,
+                'deaf_last_us': self.deaf_last_us,
+                'deaf_max_us': self.deaf_max_us,
+                'deaf_total_us': self.deaf_total_us
+            },
+            'forward_ms': {
+                'count': latency.count,
+                'mean': latency.mean(),
+                'p50': latency.percentile(50),
+                'p90': latency.percentile(90),
+                'p99': latency.percentile(99),
+                'max': latency.max,
+                'buckets': list(zip(latency.bounds + ('inf',), latency.counts))
+            },
+            'queues': {
+                'rx_ring': len(self.rx_ring),
+                'rx_ring_high_water': self.rx_ring.high_water,
+                'push_pending': self.push_pending,
+                'downlinks': len(self.downlinks) if self.downlinks else 0,
+                'class_c': len(self.class_c) if self.class_c else 0,
+                'log': len(self.log)
+            },
+            'drops': {
+                'rx_ring': self.rx_ring.drops,
+                'filter': self.filter.dropped() if self.filter else 0,
+                'dedup': self.dedup.duplicates if self.dedup else 0,
+                'duty_cycle': self.duty.refused if self.duty else 0,
+                'class_c_full': self.class_c.full if self.class_c else 0,
+                'spool': self.spool.dropped() if self.spool else 0,
+                'log': self.log.dropped
+            },
+            'filter': {
+                'passed': self.filter.passed,
+                'drops': {DROP_NAMES[i]: n for i, n in enumerate(self.filter.drops)},
+                'rules': [{'list': name, 'rule': rule, 'hits': n} for name, rule, n in self.filter.rule_hits()]
+            } if self.filter else {},
+            'downlink': self._downlink_stats(),
+            'capture': {'records': self.capture.records, 'dropped': self.capture.dropped(), 'written': self.capture.written,
+                        'rotations': self.capture.rotations, 'errors': self.capture.errors} if self.capture else {},
+            'keepalive': {
+                'pull_ms': self.pull_interval.interval_ms,
+                'pull_ceiling_ms': self.pull_interval.ceiling_ms,
+                'pull_missed': self.pull_interval.failures,
+                'stat_ms': self.stat_interval.interval_ms
+            },
+            'heap': {
+                'free': self.heap.free,
+                'min_free': self.heap.min_free,
+                'collections': self.heap.collections,
+                'gc_last_us': self.heap.gc_last_us,
+                'gc_max_us': self.heap.gc_max_us
+            },
+            'udp': {
+                'send_errors': self._send_errors(),
+                'wifi_reconnects': self.reconnects,
+                'servers': [{'host': s.host, 'up': s.up, 'acked': s.acks.acked, 'lost': s.acks.lost,
+                             'refused': s.refused, 'send_errors': s.send_errors, 'reopens': s.reopens}
+                            for s in self.servers]
+            }
+        }
+
+    def _downlink_stats(self):
+        if self.downlinks is None:
+            return {}
+        a = self.downlinks
+        c = self.class_c
+        return {
+            'class_a': {'queued': len(a), 'sent': a.sent, 'too_late': a.too_late, 'too_early': a.too_early,
+                        'collisions': a.collisions},
+            'class_c': {'queued': len(c), 'accepted': c.queued, 'sent': c.sent, 'full': c.full,
+                        'deferred': c.deferred, 'high_water': c.high_water, 'wait_mean_us': c.wait_mean_us(),
+                        'wait_max_us': c.wait_max_us}
+        }
+
+    def _queue_rxpk(self, rx_data, rx_time, tmst, freq, sf, rssi, snr):
+        """
+        Adds an rxpk object to the pending batch. The batch is pushed when it
+        is full or when the aggregation window expires, whichever comes first.
+        With a zero window every frame is pushed on its own.
+        """
+
+        with self.push_lock:
+            mark = self.push_batch.len
             try:
-                self.sock.sendto(packet, self.server_ip)
-            except Exception as ex:
-                self._log('Failed to push uplink packet to server: {}', ex)
+                if self.push_pending:
+                    self.push_batch.append(b',')
+                write_rxpk(self.push_batch, rx_time, tmst, freq, self.rx_datr[sf], rssi, snr, rx_data)
+            except Exception:
+                # never leave half an object in the batch
+                self.push_batch.len = mark
+                raise
+            self.push_pending += 1
+            pending = self.push_pending
+            if pending <= len(self.push_tmst):
+                self.push_tmst[pending - 1] = tmst
+            if pending == 1 and self.push_alarm:
+                self.push_start_ms = utime.ticks_ms()
+                self.push_alarm.callback(self._push_tick)
+                return
+        if pending >= self.push_batch_max or self.push_window_ms <= 0:
+            self._flush_rxpk()
+
+    def _flush_rxpk(self):
+        """
+        Pushes all pending rxpk objects in a single PUSH_DATA datagram.
+        """
+
+        with self.push_lock:
+            if self.push_alarm:
+                self.push_alarm.callback(None)
+            self.push_due = False
+            pending = self.push_pending
+            if not pending:
+                return
+
+            with self.udp_lock:
+                self.pkt.begin(PUSH_DATA)
+                self.pkt.append(b'{"rxpk":[')
+                self.pkt.append(self.push_batch.view())
+                self.pkt.append(b']}')
+                if self._forward_pkt():
+                    now = utime.ticks_cpu()
+                    for k in range(min(pending, len(self.push_tmst))):
+                        self.fwd_latency.add(((now - self.push_tmst[k]) & 0xFFFFFFFF) // 1000)
+            self.push_batch.reset()
+            self.push_pending = 0
+
+        self.rxfw += pending
+        self.push_batches += 1
+        self.push_saved += pending - 1
+
+    def _push_tick(self, alarm):
+        # alarm handler, shares the callback thread with the radio, so it
+        # only wakes the RX worker once the window is over
+        if self.push_pending and utime.ticks_diff(utime.ticks_ms(), self.push_start_ms) >= self.push_window_ms:
+            self.push_due = True
+            self._rx_wakeup()
+
+    def _push_expired(self):
+        """
+        Expires the unacknowledged PUSH_DATA and sends the uplinks that get a
+        second chance once more to the same server, with a new token. An
+        uplink that cannot be sent again is spooled, or counted as lost.
+        """
+
+        for server in self.servers:
+            resend = server.acks.expired()
+            if not resend:
+                continue
+            with self.udp_lock:
+                for data in resend:
+                    self.pkt.begin(PUSH_DATA)
+                    self.pkt.append(data)
+                    if self._send_pkt(server, True):
+                        continue
+                    if self.spool:
+                        self.spool.append(data)
+                    else:
+                        server.acks.give_up()
+            self.log.warning('Retransmitted {} unacknowledged uplink packets to {}', len(resend), server.host)
+
+    def _push_uplink(self, data):
+        """
+        Pushes an already encoded rxpk PUSH_DATA body.
+        """
+
+        with self.udp_lock:
+            self.pkt.begin(PUSH_DATA)
+            self.pkt.append(data)
+            self._forward_pkt()
+
+    def _forward_pkt(self):
+        """
+        Forwards the uplink PUSH_DATA in the packet builder according to the
+        server mode: to every server, or to the first healthy server that
+        accepts it. The uplink is spooled if no server could be reached.
+        Called with the UDP lock held, returns whether a server got it.
+        """
+
+        sent = False
+        if self.server_mode == SERVER_MODE_FANOUT:
+            for server in self.servers:
+                if self._send_pkt(server, True, True):
+                    sent = True
+        else:
+            # the active server first, then the others in order
+            active = self._active_server()
+            sent = self._send_pkt(active, True, True)
+            for server in self.servers:
+                if sent:
+                    break
+                if server is not active:
+                    sent = self._send_pkt(server, True, True)
+        if not sent and self.spool:
+            self.spool.append(self.pkt.view())
+        return sent
+
+    def _send_pkt(self, server, track=False, uplink=False):
+        """
+        Sends the packet in the packet builder to one server, with a token of
+        that server. Called with the UDP lock held, returns whether the
+        packet could be sent.
+        """
+
+        token = server.next_token()
+        self.pkt.set_token(token)
+        try:
+            server.sock.sendto(self.pkt.packet(), server.ip)
+        except Exception as ex:
+            server.up = False
+            server.send_errors += 1
+            self.log.warning('Failed to send to {}: {}', server.host, ex)
+            return False
+        if track:
+            server.acks.sent(token, bytes(self.pkt.view()) if uplink and server.acks.retransmit else None)
+        return True
+
+    def _active_server(self):
+        for server in self.servers:
+            if server.up:
+                return server
+        return self.servers[0]
+
+    def _backhaul_up(self):
+        for server in self.servers:
+            if server.up:
+                return True
+        return False
+
+    def _spool_replay(self):
+        """
+        Replays one spooled uplink if the server is reachable, it is time
+        to and no live uplinks are waiting. Returns the poll timeout to use
+        until the next call.
+        """
+
+        if not self.spool:
+            return UDP_POLL_TIMEOUT_MS
+        self.spool.maybe_flush()
+        if not self._backhaul_up() or self.spool.empty():
+            return UDP_POLL_TIMEOUT_MS
+        if self.push_pending or len(self.rx_ring):
+            # live traffic first
+            return self.spool_rate_ms
+        wait = self.spool_rate_ms - utime.ticks_diff(utime.ticks_ms(), self.spool_ms)
+        if wait > 0:
+            return wait
+
+        data = self.spool.pop()
+        if data is not None:
+            self.spool_ms = utime.ticks_ms()
+            self._push_uplink(data)
+        return self.spool_rate_ms
+
+    def _stat_timer(self):
+        """
+        Pushes the status, then every stat_min_s while there is traffic and
+        less often when the gateway is idle.
+        """
+
+        self._push_stat()
+        count = self.rxnb + self.dwnb
+        if count != self.stat_count:
+            interval_ms = self.stat_interval.busy()
+        else:
+            interval_ms = self.stat_interval.idle()
+        self.stat_count = count
+        if not self.timers_stop:
+            self.stat_alarm = Timer.Alarm(handler=lambda t: self._stat_timer(), ms=interval_ms)
+
+    def _pull_timer(self):
+        """
+        Sends the PULL_DATA keepalive. A PULL_ACK missing for the previous one
+        brings the interval down below the one that failed, downlinks bring it
+        to pull_min_s, and each idle interval makes the next one longer, up to
+        pull_max_s. An expired NAT binding is not noticed here, the next
+        PULL_DATA opens a new one, so pull_max_s has to stay under the NAT
+        timeout.
+        """
+
+        missed = [s.host for s in self.servers if utime.ticks_diff(s.pull_ack_ms, self.pull_sent_ms) < 0]
+        if missed:
+            if not self.pull_missed:
+                self.log.warning('No PULL_ACK from {} after {} ms, keeping the interval under {} ms', ', '.join(missed),
+                                 self.pull_interval.interval_ms, self.pull_interval.interval_ms * 3 // 4)
+            interval_ms = self.pull_interval.failed()
+        elif self.dwnb != self.pull_dwnb:
+            interval_ms = self.pull_interval.busy()
+        else:
+            interval_ms = self.pull_interval.idle()
+        self.pull_missed = bool(missed)
+        self.pull_dwnb = self.dwnb
+        self._pull_data()
+        if not self.timers_stop:
+            self.pull_alarm = Timer.Alarm(handler=lambda u: self._pull_timer(), ms=interval_ms)
 
     def _pull_data(self):
-        token = uos.urandom(2)
-        packet = bytes([PROTOCOL_VERSION]) + token + bytes([PULL_DATA]) + ubinascii.unhexlify(self.id)
         with self.udp_lock:
-            try:
-                self.sock.sendto(packet, self.server_ip)
-            except Exception as ex:
-                self._log('Failed to pull downlink packets from server: {}', ex)
+            self.pull_sent_ms = utime.ticks_ms()
+            for server in self.servers:
+                self.pkt.begin(PULL_DATA)
+                self._send_pkt(server)
 
-    def _ack_pull_rsp(self, token, error):
+    def _ack_pull_rsp(self, server, token, error):
         TX_ACK_PK["txpk_ack"]["error"] = error
         resp = ujson.dumps(TX_ACK_PK)
-        packet = bytes([PROTOCOL_VERSION]) + token + bytes([PULL_ACK]) + ubinascii.unhexlify(self.id) + resp
         with self.udp_lock:
+            # answer with the token of the PULL_RESP
+            self.pkt.begin(TX_ACK, token)
+            self.pkt.append(resp)
             try:
-                self.sock.sendto(packet, self.server_ip)
+                server.sock.sendto(self.pkt.packet(), server.ip)
             except Exception as ex:
-                self._log('PULL RSP ACK exception: {}', ex)
+                self.log.warning('PULL RSP ACK exception: {}', ex)
 
-    def _send_down_link(self, data, tmst, datarate, frequency):
+    def _duty_check(self, txpk):
         """
-        Transmits a downlink message over LoRa.
+        Returns the txpk_ack error if the downlink would exceed the duty
+        cycle of its sub-band. It is checked when the downlink is accepted,
+        its txpk_ack is sent before the transmission.
         """
 
-        self.lora.init(
-            mode=LoRa.LORA,
-            frequency=frequency,
-            bandwidth=self._dr_to_bw(datarate),
-            sf=self._dr_to_sf(datarate),
-            preamble=8,
-            coding_rate=LoRa.CODING_4_5,
-            tx_iq=True
-            )
-        #while utime.ticks_cpu() < tmst:
-        #    pass
-        self.lora_sock.send(data)
-        self._log(
-            'Sent downlink packet scheduled on {:.3f}, at {:.3f} Mhz using {}: {}',
-            tmst / 1000000,
-            self._freq_to_float(frequency),
-            datarate,
-            data
+        if self.duty is None:
+            return TX_ERR_NONE
+        if self.duty.band(txpk.freq) < 0:
+            return TX_ERR_TX_FREQ
+        if not self.duty.allowed(txpk.freq, txpk.airtime):
+            return TX_ERR_DUTY_CYCLE
+        return TX_ERR_NONE
+
+    def _send_down_link(self, txpk):
+        """
+        Transmits a class A downlink message over LoRa. Called from the
+        downlink alarm, the txpk was decoded when it was received.
+        """
+
+        self.tx_timing.fired(utime.ticks_cpu(), txpk)
+        self._deaf_begin()
+        self._setup_radio(txpk.freq, txpk.radio_bw, txpk.sf)
+        self.lora_sock.send(txpk.data)
+        self.log.info(
+            'Sent downlink packet scheduled on {} us, at {} Hz using {}: {}',
+            txpk.tmst,
+            txpk.freq,
+            txpk.datr,
+            txpk.data
         )
 
-    def _send_down_link_class_c(self, data, datarate, frequency):
-        self.lora.init(
-            mode=LoRa.LORA,
-            frequency=frequency,
-            bandwidth=self._dr_to_bw(datarate),
-            sf=self._dr_to_sf(datarate),
-            preamble=8,
-            coding_rate=LoRa.CODING_4_5,
-            tx_iq=True,
-            device_class=LoRa.CLASS_C
-            )
-
-        self.lora_sock.send(data)
-        self._log(
-            'Sent downlink packet scheduled on {:.3f}, at {:.3f} Mhz using {}: {}',
-            utime.time(),
-            self._freq_to_float(frequency),
-            datarate,
-            data
+    def _send_down_link_class_c(self, txpk):
+        """
+        Transmits a class C downlink message over LoRa. Called from the class
+        C queue alarm, the radio is marked busy so that no class A downlink
+        is scheduled over it.
+        """
+
+        self.downlinks.occupy(txpk.airtime)
+        self._deaf_begin()
+        self._setup_radio(txpk.freq, txpk.radio_bw, txpk.sf, device_class=LoRa.CLASS_C)
+        self.lora_sock.send(txpk.data)
+        self.log.info(
+            'Sent class C downlink packet at {} Hz using {}: {}',
+            txpk.freq,
+            txpk.datr,
+            txpk.data
         )
 
     def _udp_thread(self):
         """
-        UDP thread, reads data from the server and handles it.
+        UDP thread, reads data from the server and handles it. The thread
+        blocks in poll() until a packet arrives, the timeout only bounds how
+        long a udp_stop request can take to be noticed.
         """
 
+        socks = [None] * len(self.servers)
+        poller = uselect.poll()
+        if self.query_sock:
+            poller.register(self.query_sock, uselect.POLLIN)
+
         while not self.udp_stop:
             try:
-                data, src = self.sock.recvfrom(1024)
-                _token = data[1:3]
-                _type = data[3]
-                if _type == PUSH_ACK:
-                    self._log("Push ack")
-                elif _type == PULL_ACK:
-                    self._log("Pull ack")
-                elif _type == PULL_RESP:
-                    self.dwnb += 1
-                    ack_error = TX_ERR_NONE
-                    tx_pk = ujson.loads(data[4:])
-                    if "tmst" in data:
-                        tmst = tx_pk["txpk"]["tmst"]
-                        t_us = tmst - utime.ticks_cpu() - 15000
-                        if t_us < 0:
-                            t_us += 0xFFFFFFFF
-                        if t_us < 20000000:
-    					    self.uplink_alarm = Timer.Alarm(
-                                handler=lambda x: self._send_down_link(
-                                    ubinascii.a2b_base64(tx_pk["txpk"]["data"]),
-                                    tx_pk["txpk"]["tmst"] - 50, tx_pk["txpk"]["datr"],
-                                    int(tx_pk["txpk"]["freq"] * 1000) * 1000
-                                ),
-                                us=t_us
-                            )
-                        else:
-                            ack_error = TX_ERR_TOO_LATE
-                            self._log('Downlink timestamp error!, t_us: {}', t_us)
-                    else:
-                        self.uplink_alarm = Timer.Alarm(
-                            handler=lambda x: self._send_down_link_class_c(
-                                ubinascii.a2b_base64(tx_pk["txpk"]["data"]),
-                                tx_pk["txpk"]["datr"],
-                                int(tx_pk["txpk"]["freq"] * 1000) * 1000
-                            ),
-                            us=50
-                        )
-                    self._ack_pull_rsp(_token, ack_error)
-                    self._log("Pull rsp")
+                for i in range(len(self.servers)):
+                    sock = self.servers[i].sock
+                    if socks[i] is not sock:
+                        # a new socket, opened at start or by the supervisor
+                        if socks[i] is not None:
+                            poller.unregister(socks[i])
+                            socks[i].close()
+                        socks[i] = sock
+                        poller.register(sock, uselect.POLLIN)
+                self._push_expired()
+                for sock, event in poller.poll(self._spool_replay()):
+                    data, src = sock.recvfrom(1024)
+                    if sock is self.query_sock:
+                        sock.sendto(ujson.dumps(self.stats()), src)
+                        continue
+                    self._udp_handle(self.servers[socks.index(sock)], data)
             except usocket.timeout:
                 pass
             except OSError as ex:
                 if ex.errno != errno.EAGAIN:
-                    self._log('UDP recv OSError Exception: {}', ex)
+                    self.log.error('UDP recv OSError Exception: {}', ex)
             except Exception as ex:
-                self._log('UDP recv Exception: {}', ex)
-
-            # wait before trying to receive again
-            utime.sleep_ms(UDP_THREAD_CYCLE_MS)
-
-        # we are to close the socket
-        self.sock.close()
+                self.log.error('UDP recv Exception: {}', ex)
+
+        # we are to close the sockets
+        for sock in socks:
+            if sock is not None:
+                poller.unregister(sock)
+                sock.close()
+        if self.query_sock:
+            poller.unregister(self.query_sock)
+            self.query_sock.close()
+            self.query_sock = None
         self.udp_stop = False
-        self._log('UDP thread stopped')
+        self.log.info('UDP thread stopped')
 
-    def _log(self, message, *args):
+    def _udp_handle(self, server, data):
         """
-        Outputs a log message to stdout.
+        Handles a packet received from a server.
         """
 
-        print('[{:>10.3f}] {}'.format(
-            utime.ticks_ms() / 1000,
-            str(message).format(*args)
-            ))
+        _token = data[1:3]
+        _type = data[3]
+        server.up = True
+        if _type == PUSH_ACK:
+            self.log.debug("Push ack from {}, RTT {} ms", server.host, server.acks.ack((data[1] << 8) | data[2]))
+        elif _type == PULL_ACK:
+            server.pull_ack_ms = utime.ticks_ms()
+            self.log.debug("Pull ack from {}", server.host)
+        elif _type == PULL_RESP:
+            if server is not self._active_server():
+                server.refused += 1
+                self.log.warning('Ignoring downlink from {}, not the active server', server.host)
+                self._ack_pull_rsp(server, _token, TX_ERR_NOT_ACTIVE)
+                return
+            try:
+                txpk = decode_txpk(data[4:])
+            except (ValueError, KeyError, TypeError) as ex:
+                self.log.warning('Downlink rejected: invalid txpk, {}', ex)
+                self._ack_pull_rsp(server, _token, TX_ERR_INVALID)
+                return
+            self.dwnb += 1
+            txpk.radio_bw = self._khz_to_bw(txpk.bw)
+            ack_error = self._duty_check(txpk)
+            if ack_error == TX_ERR_NONE:
+                if txpk.tmst is not None:
+                    ack_error = self.downlinks.schedule(txpk.tmst, txpk.airtime, txpk)
+                else:
+                    ack_error = self.class_c.put(txpk.airtime, txpk)
+            if ack_error != TX_ERR_NONE:
+                self.log.warning('Downlink rejected: {}, tmst: {}', ack_error, txpk.tmst)
+            elif self.duty:
+                self.duty.add(txpk.freq, txpk.airtime)
+            self._ack_pull_rsp(server, _token, ack_error)
+            self.log.debug("Pull rsp")
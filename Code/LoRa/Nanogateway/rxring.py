@@ -0,0 +1,82 @@
+""" Preallocated receive ring buffer for the LoPy nano gateway. """
+
+
+class RxRing:
+    """
+    Fixed-size single producer / single consumer ring of received LoRa frames.
+    The radio callback is the only writer and the gateway RX worker the only
+    reader, so the two indexes never need a lock. All the storage is
+    allocated once, putting a frame only copies the payload into its slot.
+    """
+
+    def __init__(self, slots, mtu=256):
+        self.slots = slots
+        self.mtu = mtu
+
+        self.buf = bytearray(slots * mtu)
+        self.mv = memoryview(self.buf)
+        self.size = [0] * slots
+        self.time = [None] * slots
+        self.tmst = [0] * slots
+        self.freq = [0] * slots
+        self.sf = [0] * slots
+        self.rssi = [0] * slots
+        self.snr = [0] * slots
+
+        self.wr = 0
+        self.rd = 0
+
+        self.drops = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self.wr - self.rd
+
+    def put(self, data, rx_time, tmst, freq, sf, rssi, snr):
+        """
+        Copies a received frame into the next free slot. Returns False and
+        counts a drop if the ring is full.
+        """
+
+        used = self.wr - self.rd
+        if used >= self.slots:
+            self.drops += 1
+            return False
+
+        i = self.wr % self.slots
+        n = len(data)
+        if n > self.mtu:
+            n = self.mtu
+            data = memoryview(data)[:n]
+        off = i * self.mtu
+        self.mv[off:off + n] = data
+        self.size[i] = n
+        self.time[i] = rx_time
+        self.tmst[i] = tmst
+        self.freq[i] = freq
+        self.sf[i] = sf
+        self.rssi[i] = rssi
+        self.snr[i] = snr
+
+        self.wr += 1
+        if used + 1 > self.high_water:
+            self.high_water = used + 1
+        return True
+
+    def peek(self):
+        """
+        Returns the slot index of the oldest frame, or -1 if the ring is empty.
+        The slot stays valid until pop() is called.
+        """
+
+        if self.wr == self.rd:
+            return -1
+        return self.rd % self.slots
+
+    def payload(self, i):
+        off = i * self.mtu
+        return self.mv[off:off + self.size[i]]
+
+    def pop(self):
+        self.time[self.rd % self.slots] = None
+        self.rd += 1
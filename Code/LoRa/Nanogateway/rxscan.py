@@ -0,0 +1,81 @@
+""" Time sliced multi channel, multi SF receive scheduling for the LoPy nano gateway. """
+
+from airtime import airtime_us
+
+SCAN_CYCLE_MS = 4000
+SCAN_FRAME_SIZE = 20
+SCAN_WEIGHT = 8
+
+# hits per second of listening are kept scaled by this, plus a floor so that
+# a quiet slot still gets a share of the spare time and is noticed again
+RATE_SCALE = 256
+RATE_FLOOR = 16
+
+
+class RxScan:
+    """
+    Rotates the single LoPy receiver through a set of (frequency, SF) slots.
+    A frame is only received when the radio is tuned to its slot for the
+    whole frame, so every slot listens at least for the preamble and a
+    typical frame at its SF. The rest of the cycle is shared in proportion
+    to the rate at which each slot received frames so far, smoothed over
+    the past cycles.
+    """
+
+    def __init__(self, slots, bw_khz=125, preamble=8, cycle_ms=SCAN_CYCLE_MS,
+                 frame_size=SCAN_FRAME_SIZE, weight=SCAN_WEIGHT):
+        self.freqs = [slot[0] for slot in slots]
+        self.sfs = [slot[1] for slot in slots]
+        self.cycle_ms = cycle_ms
+        self.weight = weight
+
+        # shortest useful dwell per slot, rounded up to whole ms
+        self.min_ms = [-(-airtime_us(sf, bw_khz, frame_size, preamble, crc=True) // 1000) for sf in self.sfs]
+        self.dwell_ms = list(self.min_ms)
+
+        self.hits = [0] * len(slots)
+        self.cycle_hits = [0] * len(slots)
+        self.rate = [0] * len(slots)
+        self.current = len(slots) - 1
+        self.cycles = 0
+
+    def __len__(self):
+        return len(self.sfs)
+
+    def hit(self):
+        """
+        Counts a frame received on the current slot.
+        """
+
+        self.hits[self.current] += 1
+        self.cycle_hits[self.current] += 1
+
+    def next(self):
+        """
+        Moves to the next slot, returns its (frequency, sf, dwell_ms).
+        """
+
+        i = self.current + 1
+        if i >= len(self.sfs):
+            i = 0
+            self.cycles += 1
+            self._rebalance()
+        self.current = i
+        return (self.freqs[i], self.sfs[i], self.dwell_ms[i])
+
+    def _rebalance(self):
+        # update the smoothed hit rates with the last cycle, then share out
+        # the time left over by the minimum dwells
+        n = len(self.sfs)
+        total = 0
+        for i in range(n):
+            sample = self.cycle_hits[i] * 1000 * RATE_SCALE // self.dwell_ms[i]
+            self.rate[i] += (sample - self.rate[i]) // self.weight
+            self.cycle_hits[i] = 0
+            total += self.rate[i] + RATE_FLOOR
+
+        spare = self.cycle_ms - sum(self.min_ms)
+        for i in range(n):
+            self.dwell_ms[i] = self.min_ms[i]
+            if spare > 0:
+                self.dwell_ms[i] += spare * (self.rate[i] + RATE_FLOOR) // total
@@ -0,0 +1,269 @@
+""" Semtech UDP packet forwarder framing helpers for the LoPy nano gateway. """
+
+import ubinascii
+import uos
+
+PROTOCOL_VERSION = 2
+
+HEADER_LEN = 12
+PACKET_SIZE = 2048
+
+TX_ERR_NONE = 'NONE'
+TX_ERR_TOO_LATE = 'TOO_LATE'
+TX_ERR_TOO_EARLY = 'TOO_EARLY'
+TX_ERR_COLLISION_PACKET = 'COLLISION_PACKET'
+TX_ERR_COLLISION_BEACON = 'COLLISION_BEACON'
+TX_ERR_TX_FREQ = 'TX_FREQ'
+TX_ERR_TX_POWER = 'TX_POWER'
+TX_ERR_GPS_UNLOCKED = 'GPS_UNLOCKED'
+# not in the original protocol, the sub-band has no transmit time left
+TX_ERR_DUTY_CYCLE = 'DUTY_CYCLE'
+# not in the original protocol either, the txpk could not be decoded
+TX_ERR_INVALID = 'INVALID'
+# nor this one, the downlink came from a server other than the active one
+TX_ERR_NOT_ACTIVE = 'NOT_ACTIVE'
+
+# precompiled pieces of the rxpk and stat objects, the variable fields are
+# written between them
+_RXPK_TIME = b'{"time":"'
+_RXPK_TMST = b'","tmst":'
+_RXPK_FREQ = b',"chan":0,"rfch":0,"freq":'
+_RXPK_DATR = b',"stat":1,"modu":"LORA","datr":"'
+_RXPK_RSSI = b'","codr":"4/5","rssi":'
+_RXPK_LSNR = b',"lsnr":'
+_RXPK_SIZE = b',"size":'
+_RXPK_DATA = b',"data":"'
+_RXPK_END = b'"}'
+
+_STAT_TIME = b'{"stat":{"time":"'
+_STAT_RXNB = b' GMT","lati":0,"long":0,"alti":0,"rxnb":'
+_STAT_RXOK = b',"rxok":'
+_STAT_RXFW = b',"rxfw":'
+_STAT_ACKR = b',"ackr":'
+_STAT_DWNB = b',"dwnb":'
+_STAT_TXNB = b',"txnb":'
+_STAT_END = b'}}'
+
+
+class JsonWriter:
+    """
+    Appends JSON text to a preallocated buffer. Numbers are formatted digit
+    by digit straight into the buffer so that no intermediate str objects
+    are created.
+    """
+
+    def __init__(self, size, start=0):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.start = start
+        self.len = start
+
+    def reset(self):
+        self.len = self.start
+
+    def append(self, data):
+        """
+        Appends a bytes-like object, or an ASCII str, as is.
+        """
+
+        if isinstance(data, str):
+            data = data.encode()
+        n = len(data)
+        end = self.len + n
+        if end > len(self.buf):
+            self._grow(end)
+        self.mv[self.len:end] = data
+        self.len = end
+
+    def uint(self, n, width=1):
+        """
+        Appends a non negative integer, zero padded to width digits.
+        """
+
+        digits = 1
+        p = 10
+        while p <= n:
+            digits += 1
+            p *= 10
+        if digits < width:
+            digits = width
+        end = self.len + digits
+        if end > len(self.buf):
+            self._grow(end)
+        i = end
+        while i > self.len:
+            i -= 1
+            self.buf[i] = 0x30 + n % 10
+            n //= 10
+        self.len = end
+
+    def sint(self, n):
+        if n < 0:
+            self.append(b'-')
+            n = -n
+        self.uint(n)
+
+    def decimal(self, n, scale):
+        """
+        Appends the integer n divided by 10**scale, with trailing zeros of the
+        fraction removed but always keeping one decimal.
+        """
+
+        if n < 0:
+            self.append(b'-')
+            n = -n
+        div = 10 ** scale
+        frac = n % div
+        self.uint(n // div)
+        self.append(b'.')
+        while scale > 1 and frac % 10 == 0:
+            frac //= 10
+            scale -= 1
+        self.uint(frac, scale)
+
+    def view(self):
+        return self.mv[self.start:self.len]
+
+    def __len__(self):
+        return self.len - self.start
+
+    def _grow(self, size):
+        buf = bytearray(max(size, 2 * len(self.buf)))
+        buf[:self.len] = self.mv[:self.len]
+        self.buf = buf
+        self.mv = memoryview(buf)
+
+
+class PacketBuilder(JsonWriter):
+    """
+    Assembles Semtech UDP packets in a buffer allocated once per gateway.
+    The protocol version and the gateway EUI are written when the builder is
+    created, each packet only patches the token and the packet type in place
+    and appends its JSON body after the header.
+
+    The builder is not thread safe, callers serialize access with the same
+    lock that guards the UDP socket.
+    """
+
+    def __init__(self, gateway_id, size=PACKET_SIZE):
+        super().__init__(size, HEADER_LEN)
+        self.buf[0] = PROTOCOL_VERSION
+        self.buf[4:HEADER_LEN] = ubinascii.unhexlify(gateway_id)
+
+        # tokens only need to differ between consecutive packets, so a
+        # randomly seeded counter avoids an urandom() allocation per packet
+        seed = uos.urandom(2)
+        self.token = (seed[0] << 8) | seed[1]
+
+    def begin(self, ptype, token=None):
+        """
+        Starts a new packet of the given type and returns its token. A token
+        can be given to answer a server packet, it is copied from the first
+        two bytes of any buffer.
+        """
+
+        if token is None:
+            self.token = (self.token + 1) & 0xFFFF
+            self.buf[1] = self.token >> 8
+            self.buf[2] = self.token & 0xFF
+        else:
+            self.buf[1] = token[0]
+            self.buf[2] = token[1]
+        self.buf[3] = ptype
+        self.len = HEADER_LEN
+        return (self.buf[1] << 8) | self.buf[2]
+
+    def set_token(self, token):
+        """
+        Replaces the token of the packet being assembled, so that the same
+        packet can be sent to several servers with a token of each.
+        """
+
+        self.buf[1] = (token >> 8) & 0xFF
+        self.buf[2] = token & 0xFF
+
+    def packet(self):
+        """
+        Returns a view of the assembled packet, valid until the next begin().
+        """
+
+        return self.mv[:self.len]
+
+
+def write_rxpk(w, rx_time, tmst, freq_hz, datr, rssi, snr, data):
+    """
+    Writes one rxpk object. rx_time is an RTC.now() tuple, freq_hz the integer
+    frequency in Hz and datr the data rate string as bytes. The SNR is written
+    with one decimal like the Semtech packet forwarder does.
+    """
+
+    w.append(_RXPK_TIME)
+    w.uint(rx_time[0])
+    w.append(b'-')
+    w.uint(rx_time[1], 2)
+    w.append(b'-')
+    w.uint(rx_time[2], 2)
+    w.append(b'T')
+    w.uint(rx_time[3], 2)
+    w.append(b':')
+    w.uint(rx_time[4], 2)
+    w.append(b':')
+    w.uint(rx_time[5], 2)
+    w.append(b'.')
+    w.uint(rx_time[6], 6)
+    w.append(b'Z')
+    w.append(_RXPK_TMST)
+    w.uint(tmst)
+    w.append(_RXPK_FREQ)
+    w.decimal(freq_hz, 6)
+    w.append(_RXPK_DATR)
+    w.append(datr)
+    w.append(_RXPK_RSSI)
+    w.sint(rssi)
+    w.append(_RXPK_LSNR)
+    w.decimal(int(snr * 10 + (0.5 if snr >= 0 else -0.5)), 1)
+    w.append(_RXPK_SIZE)
+    w.uint(len(data))
+    w.append(_RXPK_DATA)
+    w.append(ubinascii.b2a_base64(data)[:-1])
+    w.append(_RXPK_END)
+
+
+def write_stat(w, now, rxnb, rxok, rxfw, ackr, dwnb, txnb, extra=None):
+    """
+    Writes the stat object. ackr is given in tenths of a percent. extra is
+    an optional sequence of (name, value) pairs of non standard integer
+    counters, added to the object after the standard fields.
+    """
+
+    w.append(_STAT_TIME)
+    w.uint(now[0])
+    w.append(b'-')
+    w.uint(now[1], 2)
+    w.append(b'-')
+    w.uint(now[2], 2)
+    w.append(b' ')
+    w.uint(now[3], 2)
+    w.append(b':')
+    w.uint(now[4], 2)
+    w.append(b':')
+    w.uint(now[5], 2)
+    w.append(_STAT_RXNB)
+    w.uint(rxnb)
+    w.append(_STAT_RXOK)
+    w.uint(rxok)
+    w.append(_STAT_RXFW)
+    w.uint(rxfw)
+    w.append(_STAT_ACKR)
+    w.decimal(ackr, 1)
+    w.append(_STAT_DWNB)
+    w.uint(dwnb)
+    w.append(_STAT_TXNB)
+    w.uint(txnb)
+    if extra:
+        for name, value in extra:
+            w.append(b',"')
+            w.append(name)
+            w.append(b'":')
+            w.sint(value)
+    w.append(_STAT_END)
@@ -0,0 +1,57 @@
+""" Network server connection state for the LoPy nano gateway. """
+
+import uos
+import usocket
+import utime
+from acks import AckTracker
+
+
+class Server:
+    """
+    One Semtech UDP network server the gateway forwards to. Each server has
+    its own socket, its own token counter and PUSH_ACK tracking, and a
+    health flag that is set whenever the server answers and cleared when
+    sending to it fails or it stops answering PULL_DATA.
+    """
+
+    def __init__(self, host, port, ack_timeout_ms, retransmit=False):
+        self.host = host
+        self.port = port
+
+        self.ip = None
+        self.sock = None
+        self.acks = AckTracker(timeout_ms=ack_timeout_ms, retransmit=retransmit)
+
+        seed = uos.urandom(2)
+        self.token = (seed[0] << 8) | seed[1]
+
+        self.up = False
+        self.pull_ack_ms = 0
+        self.dns_ms = 0
+
+        self.send_errors = 0
+        self.reopens = 0
+        self.refused = 0
+
+    def next_token(self):
+        self.token = (self.token + 1) & 0xFFFF
+        return self.token
+
+    def resolve(self):
+        """
+        Looks up the server address, returns it without applying it.
+        """
+
+        ip = usocket.getaddrinfo(self.host, self.port)[0][-1]
+        self.dns_ms = utime.ticks_ms()
+        return ip
+
+    def open(self):
+        """
+        Creates a non blocking UDP socket for the server.
+        """
+
+        sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM, usocket.IPPROTO_UDP)
+        sock.setsockopt(usocket.SOL_SOCKET, usocket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        return sock
@@ -0,0 +1,184 @@
+""" Flash-backed store-and-forward spool for the LoPy nano gateway. """
+
+import ubinascii
+import uos
+import ustruct
+import _thread
+from batch import WriteBatch
+
+SPOOL_SEGMENT_BYTES = 16384
+SPOOL_SEGMENTS = 4
+SPOOL_BATCH_BYTES = 2048
+SPOOL_FLUSH_MS = 10000
+# records waiting for the UDP thread to write them, beyond this they are
+# dropped rather than written from the packet path
+SPOOL_BUFFER_BYTES = 8192
+
+RECORD_MAGIC = 0xA5
+RECORD_HEADER = '<BHI'
+RECORD_HEADER_LEN = 7
+
+
+class Spool:
+    """
+    Append-only queue of uplink packets on flash, used while the backhaul is
+    down. Records are written to numbered segment files next to each other,
+    e.g. /flash/spool.3, /flash/spool.4, and each one carries a CRC32 so that
+    a record torn by a power loss is skipped on replay. When the spool is
+    full its oldest segment is deleted.
+
+    To limit flash wear, records are collected in RAM and written in batches
+    of batch_bytes, or when the oldest one has waited flush_ms, by whoever
+    calls maybe_flush() periodically, never by append(). Up to buffer_bytes
+    wait in RAM, records beyond are counted as dropped.
+    """
+
+    def __init__(self, path, segment_bytes=SPOOL_SEGMENT_BYTES, segments=SPOOL_SEGMENTS,
+                 batch_bytes=SPOOL_BATCH_BYTES, flush_ms=SPOOL_FLUSH_MS, buffer_bytes=SPOOL_BUFFER_BYTES):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_segments = segments
+        self.lock = _thread.allocate_lock()
+        self.batch = WriteBatch(batch_bytes, flush_ms, max_bytes=buffer_bytes)
+
+        # segment numbers on flash, oldest first; reading starts at read_off
+        # of the oldest one, writing appends to the newest one
+        self.segments = self._find_segments()
+        self.read_off = 0
+        self.write_size = self._size(self.segments[-1]) if self.segments else 0
+
+        self.appended = 0
+        self.replayed = 0
+        self.dropped_segments = 0
+        self.corrupt = 0
+
+    def append(self, data):
+        """
+        Queues one packet body, it reaches flash with the next batch.
+        """
+
+        if self.batch.add(ustruct.pack(RECORD_HEADER, RECORD_MAGIC, len(data), ubinascii.crc32(data) & 0xFFFFFFFF), data):
+            self.appended += 1
+
+    def dropped(self):
+        return self.batch.dropped
+
+    def maybe_flush(self):
+        """
+        Writes the batch if it is full or its oldest record has waited long
+        enough.
+        """
+
+        if self.batch.due():
+            with self.lock:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def empty(self):
+        with self.lock:
+            if len(self.batch):
+                return False
+            if not self.segments:
+                return True
+            return len(self.segments) == 1 and self.read_off >= self.write_size
+
+    def pop(self):
+        """
+        Returns the oldest packet body, or None when the spool is empty.
+        Records failing their CRC check are skipped.
+        """
+
+        with self.lock:
+            if len(self.batch):
+                self._flush()
+            while self.segments:
+                seg = self.segments[0]
+                data = self._read(seg)
+                if data is not None:
+                    self.replayed += 1
+                    return data
+                if len(self.segments) == 1:
+                    # everything replayed, start over with an empty spool
+                    self._remove(seg)
+                    self.segments = []
+                    self.write_size = 0
+                else:
+                    self._remove(seg)
+                    self.segments.pop(0)
+                self.read_off = 0
+            return None
+
+    def _flush(self):
+        buf = self.batch.take()
+        if not buf:
+            return
+        if not self.segments or self.write_size + len(buf) > self.segment_bytes:
+            self._new_segment()
+        with open(self._name(self.segments[-1]), 'ab') as f:
+            f.write(buf)
+        self.write_size += len(buf)
+
+    def _new_segment(self):
+        seg = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(seg)
+        self.write_size = 0
+        while len(self.segments) > self.max_segments:
+            # drop the oldest uplinks to stay within the size limit
+            self._remove(self.segments.pop(0))
+            self.read_off = 0
+            self.dropped_segments += 1
+
+    def _read(self, seg):
+        try:
+            with open(self._name(seg), 'rb') as f:
+                f.seek(self.read_off)
+                while True:
+                    header = f.read(RECORD_HEADER_LEN)
+                    if len(header) < RECORD_HEADER_LEN:
+                        return None
+                    magic, length, crc = ustruct.unpack(RECORD_HEADER, header)
+                    if magic != RECORD_MAGIC:
+                        # lost framing, the rest of the segment is unusable
+                        self.corrupt += 1
+                        return None
+                    data = f.read(length)
+                    self.read_off += RECORD_HEADER_LEN + len(data)
+                    if len(data) == length and ubinascii.crc32(data) & 0xFFFFFFFF == crc:
+                        return data
+                    self.corrupt += 1
+        except OSError:
+            return None
+
+    def _find_segments(self):
+        folder, prefix = self._split()
+        segments = []
+        for name in uos.listdir(folder):
+            if name.startswith(prefix):
+                try:
+                    segments.append(int(name[len(prefix):]))
+                except ValueError:
+                    pass
+        segments.sort()
+        return segments
+
+    def _split(self):
+        i = self.path.rfind('/')
+        return (self.path[:i] or '/', self.path[i + 1:] + '.')
+
+    def _name(self, seg):
+        return '{}.{}'.format(self.path, seg)
+
+    def _size(self, seg):
+        try:
+            return uos.stat(self._name(seg))[6]
+        except OSError:
+            return 0
+
+    def _remove(self, seg):
+        try:
+            uos.remove(self._name(seg))
+        except OSError:
+            pass